@@ -0,0 +1,210 @@
+'''Background writer for the adversarial image dumps.
+
+vutils.save_image encodes a PNG synchronously, which used to stall the
+train/test loops for every fooled sample. ArtifactWriter takes CPU copies of
+the tensors, puts them on a bounded queue and encodes them on worker threads.
+A dump (the images saved for one sample) can be sampled with a probability
+and capped per epoch.
+
+Instead of loose PNGs, dumps can also go to a PackedArchive: one append-only
+file of uint8 image arrays plus a JSONL index (batch_idx, sample, class,
+predictions). PNGs are rendered from it on demand, min-max scaled per image
+like the PNG dumps (--raw keeps the stored pixels instead):
+    python artifacts.py resnet-results/dumps --out ./classifications [--split test]
+'''
+import os
+import json
+import random
+import argparse
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+import torchvision.utils as vutils
+from PIL import Image
+
+from metrics import unnormalize
+
+
+class ArtifactWriter(object):
+    '''Saves groups of images with vutils.save_image on background threads.'''
+
+    def __init__(self, workers=1, max_queue=64, max_per_epoch=0, sample_rate=1.0, **save_kwargs):
+        self.max_per_epoch = max_per_epoch
+        self.sample_rate = sample_rate
+        self.save_kwargs = save_kwargs
+        self.count = 0
+        self.dropped = 0
+        # bounded, so a slow disk slows the loop down instead of piling up tensors in memory
+        self.queue = queue.Queue(max_queue)
+        self.threads = [threading.Thread(target=self._run) for _ in range(max(1, workers))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def new_epoch(self):
+        self.count = 0
+
+    def wanted(self):
+        '''Whether the next dump would be kept (cap not reached and sampled in).'''
+        if self.max_per_epoch > 0 and self.count >= self.max_per_epoch:
+            return False
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def submit(self, fn, *args, **kwargs):
+        '''Run fn(*args, **kwargs) on a writer thread, subject to the sampling and the cap.'''
+        if not self.wanted():
+            self.dropped += 1
+            return False
+        self.count += 1
+        self.queue.put((fn, args, kwargs))
+        return True
+
+    def dump(self, images):
+        '''Queue a list of (tensor, path) pairs to save as PNGs; returns False if the dump was skipped.'''
+        return self.submit(self._save_images, [(tensor.detach().cpu(), path) for tensor, path in images])
+
+    def dump_packed(self, archive, clean, pert, adv, **meta):
+        '''Queue one sample for a PackedArchive; returns False if the dump was skipped.'''
+        return self.submit(archive.append, clean.detach().cpu(), pert.detach().cpu(), adv.detach().cpu(), **meta)
+
+    def _save_images(self, images):
+        for tensor, path in images:
+            vutils.save_image(tensor, path, **self.save_kwargs)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args, kwargs = job
+                fn(*args, **kwargs)
+            except Exception as e:
+                print('ArtifactWriter: failed to write a dump: %s' % e)
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        '''Wait for everything queued to be written and stop the threads.'''
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def _to_uint8(x):
+    return (x.clamp(0, 1) * 255).round().byte().numpy()
+
+
+class PackedArchive(object):
+    '''Append-only archive of (clean, perturbation, adversarial) uint8 images with a JSONL index.
+
+    path + '.u8' holds the raw 3 x C x H x W uint8 arrays back to back, path + '.jsonl'
+    one record per sample with its byte offset, shape and metadata. Clean and adversarial
+    images are un-normalized with mean/std; the perturbation is min-max scaled and its
+    range stored as pert_min/pert_max so it can be mapped back.
+    '''
+
+    def __init__(self, path, mean, std):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.mean, self.std = mean, std
+        self.data = open(path + '.u8', 'ab')
+        self.index = open(path + '.jsonl', 'a')
+        self.lock = threading.Lock()
+
+    def append(self, clean, pert, adv, **meta):
+        '''Add one sample; the images are 1 x C x H x W (or C x H x W) normalized tensors.'''
+        clean = clean.view(-1, *clean.shape[-3:]).float()
+        adv = adv.view(-1, *adv.shape[-3:]).float()
+        pert = pert.view(-1, *pert.shape[-3:]).float()
+        lo, hi = pert.min().item(), pert.max().item()
+        images = np.concatenate([
+            _to_uint8(unnormalize(clean, self.mean, self.std)),
+            _to_uint8((pert - lo) / max(hi - lo, 1e-12)),
+            _to_uint8(unnormalize(adv, self.mean, self.std)),
+        ])
+        meta.update(shape=list(images.shape), pert_min=lo, pert_max=hi, mean=list(self.mean), std=list(self.std))
+        with self.lock:
+            self.data.seek(0, os.SEEK_END)
+            meta['offset'] = self.data.tell()
+            self.data.write(images.tobytes())
+            self.index.write(json.dumps(meta) + '\n')
+
+    def flush(self):
+        with self.lock:
+            self.data.flush()
+            self.index.flush()
+
+    def close(self):
+        with self.lock:
+            self.data.close()
+            self.index.close()
+
+
+def read_archive(path):
+    '''Index records of a PackedArchive, plus a memory map of its image data.'''
+    with open(path + '.jsonl') as f:
+        index = [json.loads(line) for line in f if line.strip()]
+    data = np.memmap(path + '.u8', dtype=np.uint8, mode='r') if os.path.getsize(path + '.u8') else None
+    return index, data
+
+
+def load_images(data, record):
+    '''(clean, perturbation, adversarial) uint8 C x H x W arrays of one index record.'''
+    size = int(np.prod(record['shape']))
+    return np.asarray(data[record['offset']:record['offset'] + size]).reshape(record['shape'])
+
+
+def scale_each(img, mean=None, std=None):
+    '''uint8 C x H x W image scaled like save_image(normalize=True, scale_each=True) of its normalized tensor.'''
+    x = img.astype(np.float32) / 255.
+    if mean is not None:
+        x = (x - np.asarray(mean, dtype=np.float32).reshape(-1, 1, 1)) / np.asarray(std, dtype=np.float32).reshape(-1, 1, 1)
+    lo, hi = x.min(), x.max()
+    return np.clip(np.rint((x - lo) / max(hi - lo, 1e-12) * 255), 0, 255).astype(np.uint8)
+
+
+def extract(path, out_dir, raw=False, **filters):
+    '''Render PNGs (clean, perturbed, combined) for the archive records matching all filters.
+
+    Unless raw, clean and adversarial images are min-max scaled the way the PNG dumps are,
+    so both dump formats give the same pictures (up to uint8 rounding).
+    '''
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    index, data = read_archive(path)
+    count = 0
+    for record in index:
+        if any(record.get(k) != v for k, v in filters.items()):
+            continue
+        clean, pert, adv = load_images(data, record)
+        if not raw:
+            # the perturbation is already stored min-max scaled
+            clean, adv = [scale_each(img, record.get('mean'), record.get('std')) for img in (clean, adv)]
+        clean, pert, adv = [img.transpose(1, 2, 0) for img in (clean, pert, adv)]
+        name = '%s_%s_%s_%s' % (record.get('split', ''), record.get('epoch', ''), record['batch_idx'], record['sample'])
+        Image.fromarray(clean).save(os.path.join(out_dir, name + '_clean.png'))
+        Image.fromarray(adv).save(os.path.join(out_dir, name + '_perturbed.png'))
+        Image.fromarray(np.concatenate([clean, pert, adv], 1)).save(os.path.join(out_dir, name + '_combined.png'))
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='render PNGs from a packed dump archive')
+    parser.add_argument('archive', help='archive path without extension, e.g. resnet-results/dumps')
+    parser.add_argument('--out', default='./classifications', help='folder to write the PNGs to')
+    parser.add_argument('--split', default=None, help='only samples from this split (train or test)')
+    parser.add_argument('--epoch', type=int, default=None, help='only samples from this epoch')
+    parser.add_argument('--batch_idx', type=int, default=None, help='only samples from this batch')
+    parser.add_argument('--raw', action='store_true', help='write the stored (un-normalized) pixels instead of min-max scaling like the PNG dumps')
+    opt = parser.parse_args()
+    filters = dict((k, v) for k, v in (('split', opt.split), ('epoch', opt.epoch), ('batch_idx', opt.batch_idx)) if v is not None)
+    print('%d samples extracted' % extract(opt.archive, opt.out, raw=opt.raw, **filters))
@@ -1,11 +1,26 @@
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 class _netAttacker(nn.Module):
-    ''' The attacker model is given an image and outputs a perturbed version of that image.''' 
-    def __init__(self, ngpu, imageSize):
+    ''' The attacker model is given an image and outputs a perturbed version of that image.
+
+    head selects the last layer of the generator:
+        - 'fc': a Linear layer straight to 3 x imageSize x imageSize (its size grows with the image area)
+        - 'lowres': a Linear layer to 3 x lowres x lowres, bilinearly upsampled to imageSize, so the
+          parameter count no longer depends on imageSize
+    ''' 
+    def __init__(self, ngpu, imageSize, head='fc', lowres=32):
         super(_netAttacker, self).__init__()
         self.ngpu = ngpu
         self.imageSize = imageSize
+        self.head = head
+        if head == 'fc':
+            self.outSize = imageSize
+        elif head == 'lowres':
+            self.outSize = min(lowres, imageSize)
+        else:
+            raise ValueError("unknown attacker head '%s' (fc or lowres)" % head)
         self.conv = nn.Sequential(
             # input is Z, going into a convolution
             nn.ConvTranspose2d(     100, 32 * 8, 3, 1, 0, bias=True),
@@ -45,7 +60,7 @@ class _netAttacker(nn.Module):
             nn.Linear(512, 1024),
             nn.BatchNorm1d(1024 ),
             nn.ReLU(True), # if we remove this, it seems predictions are more confident but are have greater perturbations
-            nn.Linear(1024, 3*self.imageSize*self.imageSize),
+            nn.Linear(1024, 3*self.outSize*self.outSize),
         )
         self.tanh = nn.Sequential(
             nn.Tanh(),
@@ -54,7 +69,32 @@ class _netAttacker(nn.Module):
         x = self.conv(noise)
         x = x.view(-1, 3*33*33)
         x = self.fc(x)
-        x = x.view(-1, 3, self.imageSize, self.imageSize)
+        x = x.view(-1, 3, self.outSize, self.outSize)
+        if self.outSize != self.imageSize:
+            x = F.interpolate(x, size=(self.imageSize, self.imageSize), mode='bilinear', align_corners=False)
         return x
 
 
+def margin_loss(adv_logits, targets=None):
+    ''' Mean of log p(top-1) - log p(target) over the batch, computed on device.
+
+    For an untargeted attack the target is the runner-up (top-2) class, for a targeted
+    attack it is given per sample in targets. Minimizing it pushes the target class past
+    the currently predicted one.
+    '''
+    log_probs = F.log_softmax(adv_logits.float(), 1)
+    top = log_probs.topk(2, 1)[0]
+    if targets is None:
+        targ = top[:, 1]
+    else:
+        targ = log_probs.gather(1, targets.view(-1, 1)).squeeze(1)
+    return torch.mean(top[:, 0] - targ)
+
+
+def success_loss(adv_logits, clean_labels):
+    ''' Negative mean of log p(top-1) - log p(clean label) for already fooled samples, computed on device.
+
+    Minimizing it moves the adversarial prediction further away from the original class.
+    '''
+    log_probs = F.log_softmax(adv_logits.float(), 1)
+    return -torch.mean(log_probs.max(1)[0] - log_probs.gather(1, clean_labels.view(-1, 1)).squeeze(1))
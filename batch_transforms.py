@@ -0,0 +1,46 @@
+'''Batch-level input adapters, applied once per batch on the compute device.
+
+The loaders hand over uint8 NCHW batches (4x less to copy between processes
+than float tensors). BatchAdapter turns such a batch into what the classifier
+expects in one step: optional RGB -> BGR swap, scaling to the [0, 1] or [0, 255]
+input range and per-channel normalization, folded into a single multiply-add.
+It replaces the per-image ToSpaceBGR / ToRange255 / Normalize transforms and
+also covers the ImageNet models of pretrainedmodels (see README.md), which
+describe their inputs with input_space, input_range, mean and std:
+
+    adapter = BatchAdapter.for_model(pretrainedmodels.inceptionv3())
+'''
+import torch
+
+
+class BatchAdapter(object):
+    '''uint8 (or [0, 1] float) RGB batch -> normalized classifier input in the model's space and range.'''
+
+    def __init__(self, mean, std, input_space='RGB', input_range=(0, 1)):
+        mean = torch.Tensor(list(mean))
+        std = torch.Tensor(list(std))
+        # pixel p in [0, 255] -> p / 255 * range_max, then (x - mean) / std
+        range_max = float(input_range[1])
+        self.weight = (range_max / 255. / std).view(1, -1, 1, 1)
+        self.bias = (-mean / std).view(1, -1, 1, 1)
+        self.perm = [2, 1, 0] if input_space == 'BGR' else None
+        self._on = {}
+
+    @classmethod
+    def for_model(cls, model):
+        '''Adapter for a pretrainedmodels network, from its input_space, input_range, mean and std.'''
+        return cls(model.mean, model.std, model.input_space, model.input_range)
+
+    def _params(self, device):
+        if device not in self._on:
+            self._on[device] = (self.weight.to(device), self.bias.to(device))
+        return self._on[device]
+
+    def __call__(self, batch):
+        weight, bias = self._params(batch.device)
+        if batch.dtype != torch.uint8:
+            # float input in [0, 1] (e.g. transforms.ToTensor output)
+            weight = weight * 255
+        if self.perm is not None:
+            batch = batch[:, self.perm]
+        return torch.addcmul(bias, batch.float(), weight)
@@ -0,0 +1,79 @@
+'''Benchmark the attack's backward pass with and without frozen classifier parameters.
+
+Runs netAttacker -> perturb -> DenseNet121 -> loss.backward() on random data,
+once with the classifier parameters requiring grad (the old behaviour) and
+once frozen, and reports the step time and the memory autograd keeps for the
+backward pass (plus peak CUDA memory on GPU).
+
+e.g. python bench_backward.py --device cpu --batchSize 16 --imageSize 56
+'''
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+import attack_model
+from models import DenseNet121
+from utils import freeze_parameters, weights_init
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--device', type=str, default='cpu', help='device to run on')
+parser.add_argument('--batchSize', type=int, default=16, help='input batch size')
+parser.add_argument('--imageSize', type=int, default=56, help='the height / width of the input image to network')
+parser.add_argument('--nz', type=int, default=100, help='size of the latent z vector')
+parser.add_argument('--attacker_head', type=str, default='fc', help="generator output layer: 'fc' or 'lowres'")
+parser.add_argument('--iters', type=int, default=5, help='timed iterations per setting')
+opt = parser.parse_args()
+device = torch.device(opt.device)
+
+
+def saved_bytes_hooks(counter):
+    def pack(t):
+        counter[0] += t.numel() * t.element_size()
+        return t
+    return torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t)
+
+
+def step(netAttacker, netClassifier, inputs, noise, counter):
+    netAttacker.zero_grad()
+    with saved_bytes_hooks(counter):
+        delta = netAttacker(noise)
+        adv_sample = delta * 0.01 + inputs
+        logits = netClassifier(adv_sample)
+        loss = F.cross_entropy(logits, logits.argmax(1))
+    loss.backward()
+
+
+def run(frozen):
+    torch.manual_seed(0)
+    netAttacker = attack_model._netAttacker(1, opt.imageSize, head=opt.attacker_head).to(device)
+    netAttacker.apply(weights_init)
+    netClassifier = DenseNet121().to(device).eval()
+    if frozen:
+        freeze_parameters(netClassifier)
+    inputs = torch.randn(opt.batchSize, 3, opt.imageSize, opt.imageSize, device=device)
+    noise = torch.randn(opt.batchSize, opt.nz, 1, 1, device=device)
+
+    step(netAttacker, netClassifier, inputs, noise, [0])  # warm-up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    counter = [0]
+    start = time.time()
+    for _ in range(opt.iters):
+        step(netAttacker, netClassifier, inputs, noise, counter)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = (time.time() - start) / opt.iters
+    grads = sum(1 for p in netClassifier.parameters() if p.grad is not None)
+    msg = '%-8s step %.1f ms, saved for backward %.1f MB, classifier params with grad %d' % (
+        'frozen' if frozen else 'trainable', 1000 * elapsed, counter[0] / opt.iters / 2**20, grads)
+    if device.type == 'cuda':
+        msg += ', peak CUDA memory %.1f MB' % (torch.cuda.max_memory_allocated() / 2**20)
+    print(msg)
+
+
+if __name__ == '__main__':
+    run(frozen=False)
+    run(frozen=True)
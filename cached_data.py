@@ -0,0 +1,240 @@
+'''Pre-decoded, memory-mapped image cache for the ImageFolder datasets.
+
+The images under data/train and data/test never change between epochs, so
+instead of PIL-decoding and resizing them every epoch we do it once:
+    - ingest: decode + resize every image to imageSize x imageSize and append
+      the uint8 pixels to a memory-mapped shard. Only files that were added
+      or changed since the last ingest are decoded again.
+    - CachedImageFolder: Dataset over the shards that returns uint8 CHW tensors
+      without copying them out of the memory map.
+Batches are normalized on the device by batch_transforms.BatchAdapter.
+
+Run once per imageSize, e.g.
+    python cached_data.py --imageSize 56 --cache_dir ./data/cache
+'''
+import os
+import json
+import hashlib
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+import torch
+import torch.utils.data
+from torchvision.datasets.folder import IMG_EXTENSIONS
+
+MANIFEST = 'manifest.json'
+
+
+def find_images(root):
+    '''List (relative path, class index) pairs in the same order as dset.ImageFolder.'''
+    classes = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+    samples = []
+    for label, cls in enumerate(classes):
+        for dirpath, _, fnames in sorted(os.walk(os.path.join(root, cls))):
+            for fname in sorted(fnames):
+                if fname.lower().endswith(tuple(IMG_EXTENSIONS)):
+                    samples.append((os.path.relpath(os.path.join(dirpath, fname), root), label))
+    return classes, samples
+
+
+def manifest_hash(root):
+    '''Hash of the (path, class, size, mtime) listing of an image folder; changes whenever an image does.'''
+    classes, samples = find_images(root)
+    listing = []
+    for relpath, label in samples:
+        st = os.stat(os.path.join(root, relpath))
+        listing.append((relpath, label, st.st_size, st.st_mtime))
+    return hashlib.sha1(json.dumps([classes, listing]).encode()).hexdigest()[:16]
+
+
+def _decode(args):
+    # same resize as transforms.Scale((imageSize, imageSize)), stored as CHW
+    path, imageSize = args
+    with open(path, 'rb') as f:
+        img = Image.open(f).convert('RGB')
+    img = img.resize((imageSize, imageSize), Image.BILINEAR)
+    return np.asarray(img, dtype=np.uint8).transpose(2, 0, 1)
+
+
+def _shard_path(cache_dir, name):
+    return os.path.join(cache_dir, name + '.u8')
+
+
+def _open_shard(cache_dir, shard, imageSize, mode='c'):
+    return np.memmap(_shard_path(cache_dir, shard['name']), dtype=np.uint8, mode=mode,
+                     shape=(shard['count'], 3, imageSize, imageSize))
+
+
+def _write_manifest(cache_dir, manifest):
+    tmp = os.path.join(cache_dir, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, os.path.join(cache_dir, MANIFEST))
+
+
+def _compact(cache_dir, manifest):
+    '''Rewrite all live rows into a single shard and drop the old shards.'''
+    imageSize = manifest['imageSize']
+    files = manifest['files']
+    shards = {s['name']: _open_shard(cache_dir, s, imageSize, mode='r') for s in manifest['shards']}
+    name = 'shard_%04d' % manifest['next_shard']
+    out = np.memmap(_shard_path(cache_dir, name), dtype=np.uint8, mode='w+',
+                    shape=(len(files), 3, imageSize, imageSize))
+    for row, relpath in enumerate(sorted(files)):
+        entry = files[relpath]
+        out[row] = shards[entry['shard']][entry['row']]
+        entry['shard'], entry['row'] = name, row
+    out.flush()
+    del out, shards
+    old = [s['name'] for s in manifest['shards']]
+    manifest['shards'] = [{'name': name, 'count': len(files)}]
+    manifest['next_shard'] += 1
+    _write_manifest(cache_dir, manifest)
+    for shard in old:
+        os.remove(_shard_path(cache_dir, shard))
+    return manifest
+
+
+def ingest(root, cache_dir, imageSize, workers=0):
+    '''Bring the uint8 cache of root at imageSize up to date and return its manifest.
+
+    Files are matched by relative path, size and mtime: new or changed images are
+    decoded into a fresh shard, removed ones are dropped from the manifest.
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    manifest_path = os.path.join(cache_dir, MANIFEST)
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('imageSize') != imageSize:
+            manifest = None
+    if manifest is None:
+        manifest = {'imageSize': imageSize, 'classes': [], 'shards': [], 'files': {}, 'next_shard': 0}
+
+    classes, samples = find_images(root)
+    files = manifest['files']
+    todo = []
+    present = set()
+    for relpath, label in samples:
+        present.add(relpath)
+        st = os.stat(os.path.join(root, relpath))
+        entry = files.get(relpath)
+        if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+            todo.append((relpath, label, st))
+        else:
+            entry['label'] = label
+    for relpath in list(files):
+        if relpath not in present:
+            del files[relpath]
+    manifest['classes'] = classes
+
+    if todo:
+        print('==> Caching %d new or changed images from %s..' % (len(todo), root))
+        name = 'shard_%04d' % manifest['next_shard']
+        out = np.memmap(_shard_path(cache_dir, name), dtype=np.uint8, mode='w+',
+                        shape=(len(todo), 3, imageSize, imageSize))
+        jobs = [(os.path.join(root, relpath), imageSize) for relpath, _, _ in todo]
+        if workers > 1:
+            pool = Pool(workers)
+            decoded = pool.imap(_decode, jobs, chunksize=16)
+        else:
+            pool = None
+            decoded = map(_decode, jobs)
+        for row, img in enumerate(decoded):
+            out[row] = img
+        if pool is not None:
+            pool.close()
+            pool.join()
+        out.flush()
+        del out
+        for row, (relpath, label, st) in enumerate(todo):
+            files[relpath] = {'shard': name, 'row': row, 'label': label,
+                              'size': st.st_size, 'mtime': st.st_mtime}
+        manifest['shards'].append({'name': name, 'count': len(todo)})
+        manifest['next_shard'] += 1
+
+    # forget shards nobody points to any more, compact when most rows are stale
+    used = set(entry['shard'] for entry in files.values())
+    for shard in [s for s in manifest['shards'] if s['name'] not in used]:
+        manifest['shards'].remove(shard)
+        os.remove(_shard_path(cache_dir, shard['name']))
+    total_rows = sum(s['count'] for s in manifest['shards'])
+    if len(manifest['shards']) > 1 and total_rows > 2 * len(files):
+        return _compact(cache_dir, manifest)
+    _write_manifest(cache_dir, manifest)
+    return manifest
+
+
+def cache_path(cache_dir, root, imageSize):
+    '''Directory holding the shards of root (e.g. ./data/train) at imageSize.'''
+    return os.path.join(cache_dir, '%s_%d' % (os.path.basename(os.path.normpath(root)), imageSize))
+
+
+class CachedImageFolder(torch.utils.data.Dataset):
+    '''Drop-in for dset.ImageFolder that yields (uint8 CHW tensor, class index) from the cache.'''
+
+    def __init__(self, root, cache_dir, imageSize, workers=0):
+        self.root = root
+        self.imageSize = imageSize
+        self.cache_dir = cache_path(cache_dir, root, imageSize)
+        self.manifest = ingest(root, self.cache_dir, imageSize, workers)
+        self.classes = self.manifest['classes']
+        files = self.manifest['files']
+        # keep ImageFolder's ordering so indices mean the same thing in both datasets
+        _, samples = find_images(root)
+        self.samples = [(files[relpath]['shard'], files[relpath]['row'], label) for relpath, label in samples]
+        self.targets = [label for _, _, label in self.samples]
+        self._shards = None
+
+    def _open(self):
+        # opened lazily so every loader worker maps the files itself
+        self._shards = {s['name']: _open_shard(self.cache_dir, s, self.imageSize)
+                        for s in self.manifest['shards']}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        if self._shards is None:
+            self._open()
+        shard, row, label = self.samples[index]
+        # copy-on-write map, so this is a view and not a copy
+        return torch.from_numpy(self._shards[shard][row]), label
+
+    def channel_bounds(self, chunk=256):
+        '''Per-channel uint8 (min, max) over the whole dataset, read straight from the shards.'''
+        if self._shards is None:
+            self._open()
+        rows = {}
+        for shard, row, _ in self.samples:
+            rows.setdefault(shard, []).append(row)
+        lo, hi = np.full(3, 255, dtype=np.uint8), np.zeros(3, dtype=np.uint8)
+        for shard, shard_rows in rows.items():
+            shard_rows = np.sort(shard_rows)
+            for i in range(0, len(shard_rows), chunk):
+                block = self._shards[shard][shard_rows[i:i + chunk]]
+                lo = np.minimum(lo, block.min(axis=(0, 2, 3)))
+                hi = np.maximum(hi, block.max(axis=(0, 2, 3)))
+        return lo, hi
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--imageSize', type=int, default=299, help='the height / width of the cached images')
+    parser.add_argument('--cache_dir', default='./data/cache', help='folder to write the shards to')
+    parser.add_argument('--workers', type=int, default=4, help='number of decoding processes')
+    parser.add_argument('--roots', nargs='+', default=['./data/train', './data/test'], help='image folders to cache')
+    opt = parser.parse_args()
+    for root in opt.roots:
+        manifest = ingest(root, cache_path(opt.cache_dir, root, opt.imageSize), opt.imageSize, opt.workers)
+        print('%s: %d images in %d shard(s)' % (root, len(manifest['files']), len(manifest['shards'])))
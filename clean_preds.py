@@ -0,0 +1,106 @@
+'''Clean-image predictions of the frozen target classifier, computed once per checkpoint.
+
+netClassifier never changes during the attack, so its logits on the clean
+images are the same every epoch. CleanPredictionStore runs it once over a
+dataset under no_grad, saves the logits next to the run outputs and hands
+them back by sample index to train() and test(). attackable_indices turns
+them into the subset of samples the attack should run on.
+'''
+import os
+import hashlib
+
+import torch
+import torch.utils.data
+
+from utils import make_loader
+
+
+def file_hash(path, chunk_size=1 << 20):
+    '''Content hash of a checkpoint file.'''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+class IndexedDataset(torch.utils.data.Dataset):
+    '''Wraps a dataset so every sample also carries its index: (input, class, index).'''
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        inputs, target = self.dataset[index]
+        return inputs, target, index
+
+
+class CleanPredictionStore(object):
+    '''Per-sample clean logits of the classifier, keyed by checkpoint hash and dataset listing.'''
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.logits = None
+        self.targets = None
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        saved = torch.load(self.path)
+        # files from before the targets were stored count as a miss and are refilled
+        if saved.get('key') != self.key or 'targets' not in saved:
+            return False
+        self.logits = saved['logits']
+        self.targets = saved['targets']
+        return True
+
+    def fill(self, net, dataset, batch_size, transform=None, device='cpu', num_workers=2):
+        '''Run net over dataset once, in index order, and save the logits.'''
+        loader = make_loader(dataset, batch_size, workers=num_workers, persistent=False)
+        was_training = net.training
+        net.eval()
+        logits, targets = [], []
+        print('==> Computing clean predictions for %d samples..' % len(dataset))
+        with torch.no_grad():
+            for batch in loader:
+                inputs = batch[0].to(device)
+                if transform is not None:
+                    inputs = transform(inputs)
+                logits.append(net(inputs).float().cpu())
+                targets.append(batch[1])
+        net.train(was_training)
+        self.logits = torch.cat(logits)
+        self.targets = torch.cat(targets)
+        torch.save({'key': self.key, 'logits': self.logits, 'targets': self.targets}, self.path)
+
+    def load_or_fill(self, net, dataset, batch_size, transform=None, device='cpu', num_workers=2):
+        if not self.load():
+            self.fill(net, dataset, batch_size, transform, device, num_workers)
+        return self
+
+    def to(self, device):
+        self.logits = self.logits.to(device)
+        return self
+
+    def correct(self):
+        '''Boolean mask of the samples the classifier gets right.'''
+        return self.logits.argmax(1).cpu().eq(self.targets)
+
+    def attackable_indices(self, restrict_to_correct_preds=1, target_class=None):
+        '''Indices of the samples to attack: correctly classified (if restricted) and not of the target class.'''
+        keep = torch.ones(len(self), dtype=torch.bool)
+        if restrict_to_correct_preds == 1:
+            keep &= self.correct()
+        if target_class is not None:
+            keep &= self.targets.ne(target_class)
+        return keep.nonzero().view(-1)
+
+    def __getitem__(self, idx):
+        return self.logits[idx.to(self.logits.device)]
+
+    def __len__(self):
+        return self.logits.size(0)
@@ -0,0 +1,69 @@
+'''Compare trained generators (e.g. the fc and lowres heads) on data/test.
+
+Each training run in --runs contributes its last generator. It is evaluated
+the way that run's test() did: at the run's final c, with its normalization
+and clamp bounds (see eval_setup.py). All generators attack the same test
+batches with the same noise vectors, against the same classifier. For each
+one the script prints the parameter count, the attack success rate, and the
+mean L_inf and L2 (perturbation norm / clean norm, as in main.py) of the
+fooled samples:
+
+    python compare_attackers.py --runs fc-results lowres-results
+'''
+import torch
+
+from metrics import perturbation_norms, RunningStat
+from eval_setup import eval_parser, setup, target_class, trained_run, load_classifier, test_loader
+
+
+def compare(netClassifier, attackers, loader, target_class=None):
+    '''Success rate, L_inf and L2 of each {name: (netAttacker, TrainedRun)}, all fed the same noise.
+
+    As in main.py, only correctly classified samples (and not of the target class) are attacked.
+    '''
+    counts = dict((name, {'attacked': 0, 'fooled': 0, 'L_inf': RunningStat(), 'L2': RunningStat()}) for name in attackers)
+    nz = max(run.nz for _, run in attackers.values())
+    with torch.no_grad():
+        for images, cls in loader:
+            noise = torch.randn(images.size(0), nz, 1, 1).mul_(0.5)
+            for name, (netAttacker, run) in attackers.items():
+                inputs = run.normalize(images)
+                pred = netClassifier(inputs).argmax(1)
+                keep = pred.eq(cls)
+                if target_class is not None:
+                    keep &= cls.ne(target_class)
+                if not keep.any():
+                    continue
+                inputs, pred = inputs[keep], pred[keep]
+                adv_sample = torch.clamp(netAttacker(noise[keep, :run.nz]) * run.c + inputs, run.min_val, run.max_val)
+                adv_pred = netClassifier(adv_sample).argmax(1)
+                fooled = adv_pred.eq(target_class) if target_class is not None else adv_pred.ne(pred)
+                counts[name]['attacked'] += inputs.size(0)
+                counts[name]['fooled'] += fooled.sum().item()
+                if fooled.any():
+                    norms = perturbation_norms(inputs[fooled], adv_sample[fooled], run.mean, run.std).numpy()
+                    counts[name]['L_inf'].update(norms[:, 0])
+                    counts[name]['L2'].update(norms[:, 1] / norms[:, 2])
+    results = {}
+    for name, count in counts.items():
+        netAttacker, run = attackers[name]
+        results[name] = {'success': count['fooled'] / float(max(count['attacked'], 1)),
+                         'L_inf': count['L_inf'].mean, 'L2': count['L2'].mean,
+                         'parameters': sum(p.numel() for p in netAttacker.parameters())}
+        print('%s (%s head, %d parameters, C %.6f): attack success %.4f (%d of %d), L_inf %.5f, L2 %.5f'
+              % (name, run.head, results[name]['parameters'], run.c, results[name]['success'], count['fooled'],
+                 count['attacked'], results[name]['L_inf'], results[name]['L2']))
+    return results
+
+
+if __name__ == '__main__':
+    parser = eval_parser('compare the generators of several training runs on data/test')
+    parser.add_argument('--runs', nargs='+', required=True, help='output folders (outf) of the training runs to compare')
+    opt = parser.parse_args()
+    setup(opt)
+
+    runs = [trained_run(parser, outf) for outf in opt.runs]
+    if len(set(run.imageSize for run in runs)) > 1:
+        parser.error('the runs were trained at different --imageSize values')
+    attackers = dict((run.outf, (run.attacker(), run)) for run in runs)
+    compare(load_classifier(opt.netClassifier), attackers, test_loader(opt, runs[0].imageSize), target_class(opt))
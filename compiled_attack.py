@@ -0,0 +1,165 @@
+'''The per-batch attack step, optionally compiled into one graph.
+
+Every batch of train() and test() runs the same operations:
+
+    delta = netAttacker(noise)
+    adv_sample = clamp(delta * c + inputv, min_val, max_val)
+    adv_prediction = netClassifier(adv_sample)
+
+With fewer noise vectors than images (K shared perturbations), each of the K
+deltas is broadcast over a contiguous slice of the batch: the generator runs
+K times instead of once per image, and the loss is computed as before. The
+generator's BatchNorm layers then always use their running statistics (as in
+test()): batch statistics of K samples (with K=1 they do not even exist) would
+give different deltas in training than in evaluation.
+
+The delta does not depend on c, so c_sweep evaluates several values of c at
+once: the batch is stacked under every c along the batch dimension and
+classified in a single forward.
+
+AttackStep puts them in one module, so torch.compile can fuse the
+perturb-and-clamp arithmetic into the generator and classifier graph instead
+of running it op by op. BucketedStep keeps the compiled graph stable:
+    - c, min_val and max_val are passed as 0-dim tensors, so the epoch-wise
+      updates of c do not recompile;
+    - batches are zero-padded up to the next of a few fixed sizes (the last
+      batch of an epoch, or what is left after filtering) and the outputs are
+      sliced back. Both networks run in eval mode during the step, so the
+      padded rows do not change the real ones.
+enable_compile_cache keeps the compiled kernels on disk, so the next run with
+the same models and shapes skips most of the warm-up.
+'''
+import os
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def share_index(k, n, device=None):
+    '''Delta used by each of n rows when K deltas are shared: rows [i*n/K, (i+1)*n/K) get delta i.'''
+    return torch.arange(n, device=device) * k // n
+
+
+def share_perturbations(delta, n):
+    '''Spread K deltas over a batch of n (see share_index).'''
+    k = delta.size(0)
+    if k == n:
+        return delta
+    return delta.index_select(0, share_index(k, n, delta.device))
+
+
+@contextmanager
+def eval_batchnorm(net):
+    '''Run the BatchNorm layers of net in eval mode (running statistics) inside the block.'''
+    bns = [m for m in net.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training]
+    for m in bns:
+        m.training = False
+    try:
+        yield
+    finally:
+        for m in bns:
+            m.training = True
+
+
+class AttackStep(nn.Module):
+    '''(noise, inputv, c, min_val, max_val[, index]) -> (delta, adv_sample, adv_prediction).
+
+    index, if given, says which generated delta each row of inputv gets; by default the
+    deltas are shared over the whole batch (share_perturbations).
+    '''
+
+    def __init__(self, netAttacker, netClassifier):
+        super(AttackStep, self).__init__()
+        self.netAttacker = netAttacker
+        self.netClassifier = netClassifier
+
+    def forward(self, noise, inputv, c, min_val, max_val, index=None):
+        if noise.size(0) != inputv.size(0) and self.netAttacker.training:
+            with eval_batchnorm(self.netAttacker):
+                delta = self.netAttacker(noise)
+        else:
+            delta = self.netAttacker(noise)
+        if index is None:
+            delta = share_perturbations(delta, inputv.size(0))
+        else:
+            delta = delta.index_select(0, index)
+        adv_sample = torch.clamp(delta * c + inputv, min_val, max_val)
+        return delta, adv_sample, self.netClassifier(adv_sample)
+
+
+def c_sweep(netAttacker, netClassifier, noise, inputv, cs, min_val, max_val):
+    '''Adversarial batches and logits for every c in cs, from one generator and one classifier forward.
+
+    Returns (len(cs) x N x C x H x W adversarial samples, len(cs) x N x classes logits).
+    '''
+    with torch.no_grad():
+        delta = share_perturbations(netAttacker(noise), inputv.size(0))
+        cs = torch.as_tensor(cs, dtype=delta.dtype, device=delta.device).view(-1, 1, 1, 1, 1)
+        adv_samples = torch.clamp(delta.unsqueeze(0) * cs + inputv.unsqueeze(0), min_val, max_val)
+        logits = netClassifier(adv_samples.flatten(0, 1))
+    return adv_samples, logits.view(cs.size(0), inputv.size(0), -1)
+
+
+def batch_buckets(batch_size, count=3):
+    '''Padded batch sizes: batch_size, batch_size / 2, batch_size / 4, ... (count of them).'''
+    return sorted(set(max(1, batch_size >> i) for i in range(count)))
+
+
+def enable_compile_cache(cache_dir):
+    '''Keep the inductor (and, where supported, AOT autograd) caches in cache_dir across runs.'''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(cache_dir))
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+    import torch._functorch.config as functorch_config
+    if hasattr(functorch_config, 'enable_autograd_cache'):
+        functorch_config.enable_autograd_cache = True
+
+
+def _pad(x, size):
+    # zero rows appended along the batch dimension
+    if x.size(0) == size:
+        return x
+    return F.pad(x, (0, 0) * (x.dim() - 1) + (0, size - x.size(0)))
+
+
+class BucketedStep(object):
+    '''torch.compile'd AttackStep that only ever sees a few fixed batch sizes.'''
+
+    def __init__(self, step, buckets, mode='default'):
+        self.step = torch.compile(step, mode=mode, dynamic=False)
+        self.buckets = sorted(buckets)
+
+    def __call__(self, noise, inputv, c, min_val, max_val):
+        n = inputv.size(0)
+        size = next((b for b in self.buckets if b >= n), n)
+        c, min_val, max_val = [torch.tensor(float(v), device=inputv.device) for v in (c, min_val, max_val)]
+        if noise.size(0) == n:
+            noise, index = _pad(noise, size), None
+        else:
+            # K shared deltas are spread over the n real rows, not the padded batch; padding rows get delta 0
+            index = _pad(share_index(noise.size(0), n, inputv.device), size)
+        delta, adv_sample, adv_prediction = self.step(noise, _pad(inputv, size), c, min_val, max_val, index)
+        return delta[:n], adv_sample[:n], adv_prediction[:n]
+
+
+def test_attack_step():
+    from attack_model import _netAttacker
+    netAttacker = _netAttacker(1, 32)
+    netClassifier = nn.Sequential(nn.Flatten(), nn.Linear(3*32*32, 4))
+    step = AttackStep(netAttacker, netClassifier)
+    netAttacker.train()
+    running_mean = netAttacker.fc[1].running_mean.clone()
+    inputv = torch.randn(6, 3, 32, 32)
+    for k in (1, 3):
+        delta, adv_sample, adv_prediction = step(torch.randn(k, 100, 1, 1), inputv, 0.01, -3., 3.)
+        assert delta.shape == inputv.shape and adv_prediction.shape == (6, 4)
+        # rows [i*6/k, (i+1)*6/k) share delta i; the BN running stats are not touched
+        assert torch.equal(delta[0], delta[6 // k - 1])
+        assert netAttacker.training and torch.equal(netAttacker.fc[1].running_mean, running_mean)
+    print('AttackStep with shared perturbations: ok')
+
+# test_attack_step()
@@ -0,0 +1,102 @@
+'''Shared set-up of the evaluation scripts (quantized_classifier.py, compare_attackers.py).
+
+Both evaluate generators trained by main.py, so they take their settings from
+the training run instead of their own defaults. The last finished run in
+<outf>/run.jsonl provides:
+    - 'options': imageSize, nz and the generator head;
+    - 'bounds': normalization and clamp bounds;
+    - 'final': final c and netAttacker checkpoint.
+Success rates and norms are then comparable with the run's 'val' records.
+'''
+import argparse
+
+import torch
+import torchvision.datasets as dset
+import torchvision.transforms as transforms
+
+import attack_model
+from models import DenseNet121
+from batch_transforms import BatchAdapter
+from cached_data import CachedImageFolder
+from run_logger import last_complete_run, last_record
+from utils import strip_data_parallel, make_loader
+
+
+def eval_parser(description):
+    '''ArgumentParser with the options every evaluation script shares.'''
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--netClassifier', default='./checkpoint/ckpt.pth', help="path to the classifier checkpoint")
+    parser.add_argument('--targeted', type=int, default=0, help='if 1, count a success only when the chosen target class is predicted')
+    parser.add_argument('--chosen_target_class', type=int, default=0, help='target class for a targeted attack')
+    parser.add_argument('--batchSize', type=int, default=64, help='evaluation batch size')
+    parser.add_argument('--cache_dir', type=str, default='', help='read the images from the decoding cache (see cached_data.py)')
+    parser.add_argument('--workers', type=int, default=2, help='number of data loading workers')
+    parser.add_argument('--threads', type=int, default=0, help='torch CPU threads (0 = torch default)')
+    parser.add_argument('--manualSeed', type=int, default=0, help='seed for the attack noise')
+    return parser
+
+
+def setup(opt):
+    print(opt)
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    torch.manual_seed(opt.manualSeed)
+
+
+def target_class(opt):
+    return opt.chosen_target_class if opt.targeted == 1 else None
+
+
+class TrainedRun(object):
+    '''Settings of the last finished main.py run in outf, and a loader for its generator.'''
+
+    def __init__(self, outf):
+        run = last_complete_run('%s/run.jsonl' % outf, ('options', 'bounds', 'final'))
+        options, bounds, final = [last_record(run, kind) for kind in ('options', 'bounds', 'final')]
+        self.outf = outf
+        self.imageSize = int(options['imageSize'])
+        self.nz = int(options['nz'])
+        self.head, self.lowres = str(options['attacker_head']), int(options['attacker_lowres'])
+        self.mean = [float(v) for v in bounds['mean']]
+        self.std = [float(v) for v in bounds['std']]
+        self.min_val, self.max_val = float(bounds['min_val']), float(bounds['max_val'])
+        self.c = float(final['c'])
+        self.checkpoint = str(final['netAttacker'])
+        self.normalize = BatchAdapter(self.mean, self.std)
+
+    def attacker(self, checkpoint=''):
+        '''The run's generator (eval mode), from checkpoint or the run's last one.'''
+        netAttacker = attack_model._netAttacker(1, self.imageSize, head=self.head, lowres=self.lowres)
+        netAttacker.load_state_dict(torch.load(checkpoint or self.checkpoint, map_location='cpu'))
+        return netAttacker.eval()
+
+
+def trained_run(parser, outf):
+    '''TrainedRun of outf, or a parser error if it has no finished run.'''
+    try:
+        return TrainedRun(outf)
+    except (IOError, ValueError) as e:
+        parser.error(str(e))
+
+
+def load_classifier(path):
+    '''DenseNet121 from a main.py classifier checkpoint, on the CPU in eval mode.'''
+    net = DenseNet121()
+    net.load_state_dict(strip_data_parallel(torch.load(path, map_location='cpu')['net']))
+    return net.eval()
+
+
+def image_dataset(split, imageSize, cache_dir='', workers=2):
+    '''uint8 images of data/<split>, from the decoding cache if cache_dir is given.'''
+    root = './data/%s' % split
+    if cache_dir != '':
+        return CachedImageFolder(root, cache_dir, imageSize, workers=workers)
+    return dset.ImageFolder(root=root, transform=transforms.Compose([
+        transforms.Resize((imageSize, imageSize)),
+        transforms.PILToTensor(),
+    ]))
+
+
+def test_loader(opt, imageSize):
+    return make_loader(image_dataset('test', imageSize, opt.cache_dir, opt.workers), opt.batchSize,
+                       workers=opt.workers, persistent=False)
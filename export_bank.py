@@ -0,0 +1,57 @@
+'''Export a trained attacker as a perturbation bank (see perturbation_bank.py).
+
+Samples count noise vectors, runs them through netAttacker, scales the deltas
+by the final c of the run and writes them as a quantized bank. The generator
+options, normalization, clamp bounds, final c and last checkpoint are all read
+from the run's <outf>/run.jsonl; any of them can be overridden:
+
+    python export_bank.py --outf resnet-results --count 256 --dtype uint8
+'''
+import argparse
+
+import numpy as np
+import torch
+
+import attack_model
+from run_logger import last_complete_run, last_record
+from perturbation_bank import write_bank
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--outf', default='./logs', help='output folder of the training run')
+parser.add_argument('--netAttacker', default='', help='generator checkpoint (default: the last one of the run)')
+parser.add_argument('--c', type=float, default=-1, help='perturbation scale (default: the final c of the run)')
+parser.add_argument('--count', type=int, default=256, help='number of deltas in the bank')
+parser.add_argument('--dtype', type=str, default='uint8', help="storage type of the deltas: 'uint8' or 'float16'")
+parser.add_argument('--out', default='', help='bank path without extension (default: <outf>/bank)')
+parser.add_argument('--batchSize', type=int, default=64, help='generator batch size while sampling')
+parser.add_argument('--manualSeed', type=int, default=0, help='seed for the noise vectors')
+opt = parser.parse_args()
+
+# run.jsonl is appended to by every run in outf: take all records from the last run that finished
+try:
+    run = last_complete_run('%s/run.jsonl' % opt.outf, ('options', 'bounds', 'final'))
+except ValueError as e:
+    parser.error(str(e))
+options, bounds, final = [last_record(run, kind) for kind in ('options', 'bounds', 'final')]
+c = opt.c if opt.c >= 0 else float(final['c'])
+checkpoint = opt.netAttacker or final['netAttacker']
+out = opt.out or '%s/bank' % opt.outf
+
+netAttacker = attack_model._netAttacker(1, int(options['imageSize']), head=options['attacker_head'],
+                                        lowres=int(options['attacker_lowres']))
+netAttacker.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+netAttacker.eval()
+
+torch.manual_seed(opt.manualSeed)
+deltas = []
+with torch.no_grad():
+    for start in range(0, opt.count, opt.batchSize):
+        # the same noise distribution as in train() and test()
+        noise = torch.randn(min(opt.batchSize, opt.count - start), int(options['nz']), 1, 1).mul_(0.5)
+        deltas.append((netAttacker(noise) * c).numpy())
+deltas = np.concatenate(deltas)
+
+meta = write_bank(out, deltas, opt.dtype, c=c, netAttacker=checkpoint, imageSize=int(options['imageSize']),
+                  mean=[float(v) for v in bounds['mean']], std=[float(v) for v in bounds['std']],
+                  min_val=float(bounds['min_val']), max_val=float(bounds['max_val']))
+print('%d deltas (%s, c=%g) written to %s.npy' % (meta['count'], meta['dtype'], c, out))
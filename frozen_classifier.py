@@ -0,0 +1,70 @@
+'''Frozen inference graph for the target classifier.
+
+The target classifier only ever runs in eval mode, so every BatchNorm that
+directly follows a convolution (conv1 -> bn2 in each DenseNet Bottleneck) can
+be folded into that convolution's weights. The folded model is traced to
+TorchScript, which also drops the Python module dispatch, and cached next to
+the checkpoint. The remaining pre-activation BatchNorms (bn -> relu -> conv)
+cannot be folded and stay as they are.
+
+The traced graph is not torch.jit.freeze'd: it stays a normal differentiable
+module, so gradients with respect to the input still flow for the attack loss.
+'''
+import os
+
+import torch
+from torch.fx.experimental.optimization import fuse
+
+from clean_preds import file_hash
+from utils import make_loader
+
+
+def fold_batchnorm(net):
+    '''Copy of net (in eval mode) with every Conv2d -> BatchNorm2d pair folded into one Conv2d.'''
+    net.eval()
+    folded = fuse(net)
+    folded.eval()
+    return folded
+
+
+def frozen_path(checkpoint_path, imageSize):
+    '''Where the traced classifier of checkpoint_path at imageSize is cached.'''
+    return '%s.frozen_%s_%d.pt' % (os.path.splitext(checkpoint_path)[0], file_hash(checkpoint_path), imageSize)
+
+
+def check_outputs(reference, frozen, loader, transform=None, device='cpu', rtol=1e-3, atol=1e-3):
+    '''Compare the logits of frozen against reference over loader; raise if they disagree.'''
+    max_diff, agree, total = 0., 0, 0
+    with torch.no_grad():
+        for batch in loader:
+            inputs = batch[0].to(device)
+            if transform is not None:
+                inputs = transform(inputs)
+            ref = reference(inputs)
+            out = frozen(inputs)
+            max_diff = max(max_diff, (out - ref).abs().max().item())
+            agree += out.argmax(1).eq(ref.argmax(1)).sum().item()
+            total += inputs.size(0)
+            if not torch.allclose(out, ref, rtol=rtol, atol=atol):
+                raise ValueError('frozen classifier differs from the original (max abs logit diff %.6f)' % max_diff)
+    print('Frozen classifier check: max abs logit diff %.6f, top-1 agreement %d/%d' % (max_diff, agree, total))
+    return max_diff
+
+
+def load_frozen_classifier(net, checkpoint_path, imageSize, device, check_dataset=None, transform=None, batch_size=64, workers=2):
+    '''Traced, BN-folded version of net, loaded from the cache or built (and checked on check_dataset).'''
+    path = frozen_path(checkpoint_path, imageSize)
+    if os.path.exists(path):
+        print('=> loading frozen classifier from %s' % path)
+        return torch.jit.load(path, map_location=device)
+
+    print('=> building frozen classifier')
+    net.eval()
+    folded = fold_batchnorm(net).to(device)
+    example = torch.randn(1, 3, imageSize, imageSize, device=device)
+    frozen = torch.jit.trace(folded, example)
+    if check_dataset is not None:
+        loader = make_loader(check_dataset, batch_size, workers=workers, persistent=False)
+        check_outputs(net, frozen, loader, transform, device)
+    torch.jit.save(frozen, path)
+    return frozen
@@ -9,14 +9,11 @@ import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.optim as optim
 import torch.utils.data
-import torch.nn.functional as F
 import torchvision.datasets as dset
 import torchvision.transforms as transforms
-import torchvision.utils as vutils
 from torch.autograd import Variable
 from torchvision import models
 from torch.utils.data.sampler import SubsetRandomSampler, RandomSampler
-torch.cuda.empty_cache()
 
 from colorama import *
 
@@ -29,11 +26,22 @@ import math
 
 from utils import *
 import attack_model
+from cached_data import CachedImageFolder, manifest_hash
+from batch_transforms import BatchAdapter
+from clean_preds import CleanPredictionStore, IndexedDataset, file_hash
+from frozen_classifier import load_frozen_classifier
+from compiled_attack import AttackStep, BucketedStep, batch_buckets, enable_compile_cache, c_sweep
+from metrics import perturbation_norms, RunningStat
+from run_logger import RunLogger
+from artifacts import ArtifactWriter, PackedArchive
 from models import *
 #from pretrained_models_pytorch import pretrainedmodels
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--workers', type=int, help='number of data loading workers', default=2)
+parser.add_argument('--persistent_workers', type=int, default=1, help='if 1, keep data loading workers alive between epochs')
+parser.add_argument('--prefetch_factor', type=int, default=2, help='batches prefetched per data loading worker')
+parser.add_argument('--pin_memory', type=int, default=1, help='if 1, load batches into pinned memory when running on cuda')
 parser.add_argument('--batchSize', type=int, default=128, help='input batch size')
 parser.add_argument('--epochs', type=int, default=20, help='number of epochs to train for')
 parser.add_argument('--lr', type=float, default=0.0002, help='learning rate, default=0.0002')
@@ -52,46 +60,74 @@ parser.add_argument('--l2reg', type=float, default=0.01, help='weight factor for
 parser.add_argument('--max_norm', type=float, default=0.04, help='max allowed perturbation')
 parser.add_argument('--norm', type=str, default='linf', help='l2 or linf')
 parser.add_argument('--cuda', action='store_true', help='enables cuda')
+parser.add_argument('--device', type=str, default='', help="device to run on, e.g. 'cpu', 'cuda' or 'cuda:1' (default: cuda if --cuda is set, else cpu)")
+parser.add_argument('--threads', type=int, default=0, help='number of intra-op CPU threads (0 = torch default)')
+parser.add_argument('--interop_threads', type=int, default=0, help='number of inter-op CPU threads (0 = torch default)')
+parser.add_argument('--frozen_classifier', type=int, default=0, help='if 1, run the classifier as a traced graph with BatchNorm folded into the convolutions (built once, checked on data/test and cached next to the checkpoint)')
+parser.add_argument('--memory_efficient', type=int, default=0, help='if 1, recompute the DenseNet bottlenecks during backward instead of storing them (fits larger batches; ignored with --frozen_classifier 1)')
+parser.add_argument('--amp', type=int, default=0, help='if 1, run the generator and classifier forward/backward under autocast (bf16 on CPU, fp16 with loss scaling on CUDA); losses and norms stay in fp32')
+parser.add_argument('--amp_compare', type=int, default=1, help='with --amp 1, also run the fp32 attack in test() and report how far the success rate differs (skipped with --compile 1)')
+parser.add_argument('--shared_perturbations', type=int, default=0, help='if K > 0, draw K noise vectors per batch and share each delta over a slice of the batch (0 = one per sample)')
+parser.add_argument('--c_search', type=int, default=0, help='if 1, choose c during training from a held-out batch (see --c_multipliers) instead of the epoch-wise --shrink_inc schedule')
+parser.add_argument('--c_multipliers', type=float, nargs='+', default=[0.5, 0.75, 1., 1.5, 2., 3.], help='candidate values of c, as multiples of the current c, evaluated in one forward')
+parser.add_argument('--c_search_every', type=int, default=50, help='train batches between two c searches')
+parser.add_argument('--c_search_success', type=float, default=0.9, help='the search picks the smallest candidate c with at least this success rate on the held-out batch (else the next larger one)')
+parser.add_argument('--compile', type=int, default=0, help='if 1, torch.compile the generator -> perturb -> clamp -> classifier step as one graph')
+parser.add_argument('--compile_mode', type=str, default='default', help="torch.compile mode ('default', 'reduce-overhead' or 'max-autotune')")
+parser.add_argument('--compile_buckets', type=int, default=3, help='number of fixed batch sizes (batchSize, batchSize/2, ...) smaller batches are padded to')
+parser.add_argument('--compile_cache', type=str, default='./data/cache/compile', help='folder the compiled kernels are cached in across runs')
+parser.add_argument('--channels_last', type=int, default=0, help='if 1, run the classifier on channels_last tensors (usually faster on CPU)')
 parser.add_argument('--ngpu', type=int, default=1, help='number of GPUs to use')
+parser.add_argument('--hist_bins', type=int, default=0, help='if > 0, also log per-epoch histograms of L_inf and L2 with this many bins')
+parser.add_argument('--recheck', type=int, default=0, help='if 1, test() re-classifies the fooled samples of each batch (one batched forward) and reports changed predictions')
+parser.add_argument('--dump_workers', type=int, default=1, help='number of background threads writing adversarial image dumps')
+parser.add_argument('--dump_queue', type=int, default=64, help='max number of image dumps waiting to be written')
+parser.add_argument('--dump_format', type=str, default='png', help="'png' (loose PNG files) or 'packed' (one append-only archive in outf/dumps, see artifacts.py to render PNGs)")
+parser.add_argument('--max_dumps', type=int, default=0, help='max number of samples dumped as images per epoch (0 = no limit)')
+parser.add_argument('--dump_rate', type=float, default=1.0, help='fraction of the fooled samples dumped as images')
 parser.add_argument('--every', type=int, default=1, help='save if epoch is divisible by this')
 parser.add_argument('--nz', type=int, default=100, help='size of the latent z vector')
 parser.add_argument('--imageSize', type=int, default=299, help='the height / width of the input image to network')
+parser.add_argument('--attacker_head', type=str, default='fc', help="generator output layer: 'fc' (full-resolution Linear, grows with imageSize^2) or 'lowres' (Linear to --attacker_lowres, then bilinear upsample)")
+parser.add_argument('--attacker_lowres', type=int, default=32, help='output resolution of the lowres generator head before upsampling')
 parser.add_argument('--netAttacker', default='', help="path to netAttacker (to continue training)")
 parser.add_argument('--netClassifier', default='./checkpoint/ckpt.pth', help="For CIFAR-10: path to netClassifier (to get target model predictions) \
                                                                              For ImageNet: type of classifier (e.g. inceptionV3)")
 parser.add_argument('--outf', default='./logs', help='folder to output images and model checkpoints')
 parser.add_argument('--manualSeed', type=int, default=5198, help='manual seed')
 parser.add_argument('--dataset', type=str, default='', help='dataset images path')
+parser.add_argument('--boundaries', type=str, default='data', help="clamp bounds for adversarial images: 'data' (min/max of the normalized train set, cached) or 'analytic' (range of Normalize on [0, 1])")
+parser.add_argument('--norm_stats', type=str, default='', help='JSON file of per-dataset normalization constants; if set, the mean/std of data/train are loaded from it (computed and stored on first use) instead of using the CIFAR-10 constants')
+parser.add_argument('--cache_dir', type=str, default='', help='if set, read pre-decoded uint8 images from memory-mapped shards in this folder (see cached_data.py)')
 
 opt = parser.parse_args()
+if opt.device == '':
+    opt.device = 'cuda' if opt.cuda else 'cpu'
+opt.cuda = opt.device.startswith('cuda')
+if opt.compile == 1 and opt.amp == 1 and opt.amp_compare == 1:
+    # the fp32 rerun would compile the step a second time (no autocast, no grad) just for the comparison
+    print("WARNING: --amp_compare is skipped with --compile 1")
+    opt.amp_compare = 0
+if opt.compile == 1 and opt.frozen_classifier == 1:
+    print("WARNING: --frozen_classifier is ignored with --compile 1 (a traced graph cannot be compiled)")
+    opt.frozen_classifier = 0
 print(opt)
 
-WriteToFile('./%s/log' %(opt.outf), opt)
-WriteToFile('./%s/classifications' %(opt.outf), opt)
+device = torch.device(opt.device)
+if opt.threads > 0:
+    torch.set_num_threads(opt.threads)
+if opt.interop_threads > 0:
+    torch.set_num_interop_threads(opt.interop_threads)
 
+# one JSONL record per batch summary / classified sample, see run_logger.read_run
+logger = RunLogger('./%s/run.jsonl' %(opt.outf))
+logger.log('options', **vars(opt))
 
-class ToSpaceBGR(object):
+# PNG dumps of adversarial examples are encoded off the train/test loops
+writer = ArtifactWriter(workers=opt.dump_workers, max_queue=opt.dump_queue, max_per_epoch=opt.max_dumps,
+                        sample_rate=opt.dump_rate, normalize=True, scale_each=True)
+archive = None
 
-    def __init__(self, is_bgr):
-        self.is_bgr = is_bgr
-
-    def __call__(self, tensor):
-        if self.is_bgr:
-            new_tensor = tensor.clone()
-            new_tensor[0] = tensor[2]
-            new_tensor[2] = tensor[0]
-            tensor = new_tensor
-        return tensor
-
-class ToRange255(object):
-
-    def __init__(self, is_255):
-        self.is_255 = is_255
-
-    def __call__(self, tensor):
-        if self.is_255:
-            tensor.mul_(255)
-        return tensor
 
 if opt.manualSeed is None:
     opt.manualSeed = random.randint(1, 10000)
@@ -112,130 +148,278 @@ ngpu = int(opt.ngpu)
 
 
 # set-up models and load weights if any are saved
-netAttacker = attack_model._netAttacker(ngpu, opt.imageSize)
+netAttacker = attack_model._netAttacker(ngpu, opt.imageSize, head=opt.attacker_head, lowres=opt.attacker_lowres)
+print('netAttacker parameters: %d' % sum(p.numel() for p in netAttacker.parameters()))
 netAttacker.apply(weights_init)
 if opt.netAttacker != '':
-    netAttacker.load_state_dict(torch.load(opt.netAttacker))
+    netAttacker.load_state_dict(torch.load(opt.netAttacker, map_location=device))
     print("Net attacker loaded!!\n")
 
 print("=> creating model ")
-checkpoint = torch.load(opt.netClassifier)
-net = DenseNet121()
-net = net.to('cuda')
-net = torch.nn.DataParallel(net)
-cudnn.benchmark = True
-net.load_state_dict(checkpoint['net'])
-torch.cuda.empty_cache()
-print('debug: emptied cache after net!')
+checkpoint = torch.load(opt.netClassifier, map_location=device)
+if opt.memory_efficient == 1 and opt.frozen_classifier == 1:
+    print("WARNING: --memory_efficient is ignored by the frozen (traced) classifier")
+net = DenseNet121(memory_efficient=opt.memory_efficient == 1 and opt.frozen_classifier == 0)
+# the checkpoint was saved from a DataParallel model; load it into the bare net and only wrap it again on multiple GPUs
+net.load_state_dict(strip_data_parallel(checkpoint['net']))
+net = net.to(device)
+if opt.channels_last == 1:
+    net = net.to(memory_format=torch.channels_last)
+if opt.cuda:
+    torch.cuda.empty_cache()
 netClassifier = net
 
-
-if opt.cuda:
-    netAttacker.cuda()
-    netClassifier.cuda()
+netAttacker.to(device)
 
 
 print('==> Preparing data..')
+norm_mean, norm_std = (0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)
+if opt.norm_stats != '':
+    def compute_norm_stats():
+        if opt.cache_dir != '':
+            rawset = CachedImageFolder('./data/train', opt.cache_dir, opt.imageSize, workers=opt.workers)
+        else:
+            rawset = dset.ImageFolder(root = './data/train', transform = transforms.Compose([
+                transforms.Resize((opt.imageSize,opt.imageSize)),
+                transforms.PILToTensor(),
+            ]))
+        to_unit = lambda x: x.float().div(255)
+        mean, std = get_mean_and_std(rawset, batch_size=256, num_workers=opt.workers, transform=to_unit)
+        return mean.tolist() + std.tolist()
+    key = {'samples': manifest_hash('./data/train'), 'imageSize': opt.imageSize}
+    stats = cached_result(opt.norm_stats, key, compute_norm_stats)
+    norm_mean, norm_std = tuple(stats[:3]), tuple(stats[3:])
+    print('Normalization: mean %s std %s' % (norm_mean, norm_std))
+# the workers only resize and hand over uint8 images; float conversion and Normalize (and for
+# pretrainedmodels networks the BGR swap / 0-255 range, see BatchAdapter.for_model) happen once per batch on the device
 transform_train = transforms.Compose([
-        transforms.Scale((opt.imageSize,opt.imageSize)),
-        transforms.ToTensor(),
-        transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
+        transforms.Resize((opt.imageSize,opt.imageSize)),
+        transforms.PILToTensor(),
     ])
 
 transform_test = transforms.Compose([
-    transforms.Scale((opt.imageSize,opt.imageSize)),
-    transforms.ToTensor(),
-    transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
+    transforms.Resize((opt.imageSize,opt.imageSize)),
+    transforms.PILToTensor(),
 ])
 
-#loading of image data. Image data consits of batch_idx, input (image), targets (correct classification - groundtruth)
-trainset = dset.ImageFolder(root = './data/train', transform = transform_train)
-trainloader = torch.utils.data.DataLoader(
-    trainset, batch_size=opt.batchSize, shuffle=True, num_workers=2)
+if opt.dump_format == 'packed':
+    archive = PackedArchive('./%s/dumps' %(opt.outf), norm_mean, norm_std)
 
+normalize_batch = BatchAdapter(norm_mean, norm_std)
 
-testset = dset.ImageFolder(root = './data/test', transform = transform_test)
-testloader = torch.utils.data.DataLoader(
-    testset, batch_size=opt.batchSize, shuffle=False, num_workers=2)
+#loading of image data. Image data consits of batch_idx, input (image), targets (correct classification - groundtruth)
+if opt.cache_dir != '':
+    trainset = CachedImageFolder('./data/train', opt.cache_dir, opt.imageSize, workers=opt.workers)
+    testset = CachedImageFolder('./data/test', opt.cache_dir, opt.imageSize, workers=opt.workers)
+else:
+    trainset = dset.ImageFolder(root = './data/train', transform = transform_train)
+    testset = dset.ImageFolder(root = './data/test', transform = transform_test)
+# loaders also yield the sample index, used to look up the cached clean predictions
+trainset, testset = IndexedDataset(trainset), IndexedDataset(testset)
 
 classes = ('black', 'green','red', 'yellow')
 
+if opt.frozen_classifier == 1:
+    # the traced graph runs on a single device
+    netClassifier = load_frozen_classifier(net, opt.netClassifier, opt.imageSize, device,
+                                           check_dataset=testset, transform=normalize_batch, batch_size=opt.batchSize,
+                                           workers=opt.workers)
+elif opt.cuda and ngpu > 1:
+    netClassifier = torch.nn.DataParallel(net, device_ids=range(ngpu))
+# only the attacker is trained: no weight gradients (or the activations they need) for the classifier
+freeze_parameters(netClassifier)
+
+# generator -> perturb -> clamp -> classifier, the same for every train and test batch
+attack_step = AttackStep(netAttacker, netClassifier)
+if opt.compile == 1:
+    enable_compile_cache(opt.compile_cache)
+    attack_step = BucketedStep(attack_step, batch_buckets(opt.batchSize, opt.compile_buckets), mode=opt.compile_mode)
+
+# the classifier is frozen, so its clean predictions are computed once per checkpoint and reused every epoch
+classifier_hash = file_hash(opt.netClassifier)
+def clean_predictions(split, dataset):
+    key = {'checkpoint': classifier_hash, 'samples': manifest_hash('./data/%s' % split),
+           'imageSize': opt.imageSize, 'mean': norm_mean, 'std': norm_std}
+    store = CleanPredictionStore('./%s/clean_logits_%s_%s.pth' % (opt.outf, split, classifier_hash), key)
+    store.load_or_fill(netClassifier, dataset, opt.batchSize, normalize_batch, device, opt.workers)
+    return store.to(device)
+
+train_logits = clean_predictions('train', trainset)
+test_logits = clean_predictions('test', testset)
+
+# the loaders only visit the samples worth attacking (correctly classified, and not of the target class
+# if targeted), so every batch is full and nothing has to be filtered per batch
+target_class = opt.chosen_target_class if opt.targeted == 1 else None
+train_attackable = train_logits.attackable_indices(opt.restrict_to_correct_preds, target_class)
+test_attackable = test_logits.attackable_indices(opt.restrict_to_correct_preds, target_class)
+if len(train_attackable) == 0 or len(test_attackable) == 0:
+    print("No samples left to attack after filtering!")
+    exit()
+heldout_idx = None
+if opt.c_search == 1:
+    # one batch of attackable train samples is set aside to choose c on (kept in training if there are too few)
+    perm = train_attackable[torch.randperm(len(train_attackable), generator=torch.Generator().manual_seed(opt.manualSeed))]
+    heldout_idx = perm[:opt.batchSize]
+    if len(perm) >= 2 * opt.batchSize:
+        train_attackable = perm[opt.batchSize:]
+# samples skipped because the original prediction is incorrect
+train_skipped = int((~train_logits.correct()).sum()) if opt.restrict_to_correct_preds == 1 else 0
+test_skipped = int((~test_logits.correct()).sum()) if opt.restrict_to_correct_preds == 1 else 0
+
+pin_memory = opt.pin_memory == 1 and opt.cuda
+def loader(dataset, **kwargs):
+    settings = dict(workers=opt.workers, persistent=opt.persistent_workers == 1, prefetch=opt.prefetch_factor, pin_memory=pin_memory)
+    settings.update(kwargs)
+    return make_loader(dataset, opt.batchSize, **settings)
+
+trainloader = loader(trainset, sampler=SubsetRandomSampler(train_attackable.tolist()),
+                     drop_last=len(train_attackable) >= opt.batchSize)
+testloader = loader(testset, sampler=test_attackable.tolist())
+
  
 # setup optimizer
 optimizerAttacker = optim.Adam(netAttacker.parameters(), lr=opt.lr, betas=(opt.beta1, 0.999), weight_decay=opt.l2reg)
+# loss scaling is only needed (and only enabled) for fp16 autocast on CUDA; otherwise it passes through
+scaler = torch.amp.GradScaler('cuda', enabled=opt.amp == 1 and opt.cuda)
 
 # pre-set noise variable
-noise = torch.FloatTensor(opt.batchSize, opt.nz, 1, 1)
-if opt.cuda:
-    noise = noise.cuda()
+noise = torch.FloatTensor(opt.batchSize, opt.nz, 1, 1).to(device)
 noise = Variable(noise)
 
+def noise_count(batch_size):
+    '''Number of noise vectors (and generator outputs) for a batch: one per sample, or K shared ones.'''
+    if opt.shared_perturbations > 0:
+        return min(opt.shared_perturbations, batch_size)
+    return batch_size
+
+def to_input(batch):
+    '''Normalize a (possibly uint8) batch that is already on the device and match the classifier's memory format.'''
+    batch = normalize_batch(batch)
+    if opt.channels_last == 1:
+        batch = batch.contiguous(memory_format=torch.channels_last)
+    return batch
+
+def record_norms(yes_idx, inputv, adv_sample, L_inf, dist, pert_norm, adv_norm, non_adv_norm):
+    '''Add the norms of the successful adversarial examples of a batch, with one device-to-host copy.'''
+    yes = torch.LongTensor(yes_idx).to(inputv.device)
+    norms = perturbation_norms(inputv.index_select(0, yes), adv_sample.index_select(0, yes), norm_mean, norm_std).cpu().numpy()
+    L_inf.update(norms[:, 0]) #linf = perturbed image - clean image
+    pert_norm.update(norms[:, 1])
+    non_adv_norm.update(norms[:, 2])
+    adv_norm.update(norms[:, 3])
+    dist.update(norms[:, 1] / norms[:, 2])
+
+TRAIN_FIELDS = ('c_loss', 'success', 'L_inf', 'L2', 'pert_norm', 'adv_norm', 'clean_norm', 'c', 'skipped_pct')
+VAL_FIELDS = TRAIN_FIELDS[1:]
+
+def new_stats():
+    '''Running aggregates for c_loss, L_inf, pert_norm, dist, adv_norm and non_adv_norm.
+
+    Only L_inf and dist get histograms (see log_histograms); the others are outside [0, 1] anyway.
+    '''
+    return [RunningStat(), RunningStat(opt.hist_bins), RunningStat(), RunningStat(opt.hist_bins), RunningStat(), RunningStat()]
+
+def log_histograms(prefix, epoch, L_inf, dist):
+    if opt.hist_bins > 0:
+        for name, stat in (('L_inf', L_inf), ('L2', dist)):
+            edges, counts = stat.histogram()
+            logger.log('histogram', split=prefix, epoch=epoch, metric=name, edges=edges, counts=counts)
+
+def log_timing(prefix, epoch, timed_loader, samples, elapsed):
+    print('%s E%s %.1f samples/s, loader stall %.2fs of %.2fs' % (prefix, epoch, samples / max(elapsed, 1e-9), timed_loader.stall, elapsed))
+    logger.log('loader', split=prefix, epoch=epoch, stall=timed_loader.stall, elapsed=elapsed,
+               samples_per_sec=samples / max(elapsed, 1e-9), amp=opt.amp)
+
+def heldout_batch():
+    '''The held-out train batch for the c search: (normalized inputs, clean logits) on the device.'''
+    inputs = torch.stack([trainset[i][0] for i in heldout_idx.tolist()])
+    return to_input(inputs.to(device)), train_logits[heldout_idx]
+
+def search_c(c, epoch, batch_idx, heldout):
+    '''Success rate and norms of every candidate c on the held-out batch, in one forward; returns the chosen c.'''
+    inputv, prediction = heldout
+    candidates = sorted(c * m for m in opt.c_multipliers)
+    heldout_noise = torch.randn(noise_count(inputv.size(0)), opt.nz, 1, 1, device=device).mul_(0.5)
+    # score the eval-mode deltas that test() and export_bank.py use, without touching the BN running stats
+    was_training = netAttacker.training
+    netAttacker.eval()
+    with autocast(device, opt.amp == 1):
+        adv_samples, adv_logits = c_sweep(netAttacker, netClassifier, heldout_noise, inputv, candidates, min_val, max_val)
+    netAttacker.train(was_training)
+    if opt.targeted == 1:
+        fooled = adv_logits.argmax(2).eq(opt.chosen_target_class)
+    else:
+        fooled = adv_logits.argmax(2).ne(prediction.argmax(1).unsqueeze(0))
+    success = fooled.float().mean(1).tolist()
+    norms = perturbation_norms(inputv.repeat(len(candidates), 1, 1, 1), adv_samples.flatten(0, 1), norm_mean, norm_std)
+    norms = norms.view(len(candidates), inputv.size(0), 4).mean(1).cpu().numpy()
+    L_inf, L2 = norms[:, 0], norms[:, 1] / norms[:, 2]
+    # candidates whose L_inf is above --max_norm are never chosen; if none of the others is successful enough,
+    # c grows by at most one candidate step per search, like the additive --shrink_inc schedule
+    allowed = [i for i in range(len(candidates)) if L_inf[i] <= opt.max_norm]
+    reached = [i for i in allowed if success[i] >= opt.c_search_success]
+    larger = [i for i in allowed if candidates[i] > c]
+    if reached:
+        chosen = candidates[reached[0]]
+    elif larger:
+        chosen = candidates[larger[0]]
+    else:
+        chosen = c
+    print('\nc search E%s B%s: %s -> C %.6f' % (epoch, batch_idx, ', '.join('%.6f: %.3f (L_inf %.4f L2 %.4f)' % row
+                                                                        for row in zip(candidates, success, L_inf, L2)), chosen))
+    logger.log('c_search', epoch=epoch, batch_idx=batch_idx, c=candidates, success=success, L_inf=L_inf, L2=L2, chosen=chosen)
+    return chosen
+
+def clamp_boundaries():
+    '''Clamp bounds for the adversarial images, without an extra pass over the train set when possible.'''
+    if opt.boundaries == 'analytic':
+        return analytic_boundaries(norm_mean, norm_std)
+    def compute():
+        if opt.cache_dir != '':
+            lo, hi = trainset.dataset.channel_bounds()
+            return uint8_boundaries(lo, hi, norm_mean, norm_std)
+        return find_boundaries(loader(trainset, persistent=False), transform=normalize_batch)
+    key = {'samples': manifest_hash('./data/train'), 'imageSize': opt.imageSize, 'mean': norm_mean, 'std': norm_std}
+    return cached_result('./%s/boundaries.json' % opt.outf, key, compute)
+
 def train(epoch, c, noise):
     # set-up structures to track norms, losses etc.
     netAttacker.train()
     netClassifier.eval()
-    c_loss, L_inf, L2, pert_norm, dist, adv_norm, non_adv_norm = [ ], [ ], [ ], [ ], [ ], [ ], [ ] 
-    total_count, success_count, skipped, no_skipped = 0, 0, 0, 0
+    c_loss, L_inf, pert_norm, dist, adv_norm, non_adv_norm = new_stats()
+    writer.new_epoch()
+    total_count, success_count = 0, 0
+    skipped, no_skipped = train_skipped, len(train_logits) - train_skipped
+    start = time.time()
      
-    for batch_idx, (inputv, cls) in enumerate(trainloader):
+    for batch_idx, (inputv, cls, idx) in enumerate(trainloader):
         #train loader refers to the training set
         optimizerAttacker.zero_grad() #optimizerAttacker is the UAN attack model
         batch_size = inputv.size(0)
-        targets = torch.LongTensor(batch_size)
-        if opt.cuda:
-            inputv = inputv.cuda()
-            targets = targets.cuda()
-            cls = cls.cuda()
-        inputv = Variable(inputv)
+        targets = torch.LongTensor(batch_size).to(device)
+        inputv = inputv.to(device, non_blocking=pin_memory)
+        cls = cls.to(device, non_blocking=pin_memory)
+        inputv = Variable(to_input(inputv))
         targets = Variable(targets)
-        torch.cuda.empty_cache()
-        prediction = netClassifier(inputv) #prediction is the set of data that is predicted by the DenseNet
-
-        # only computer adversarial examples on examples that are originally classified correctly        
-        if opt.restrict_to_correct_preds == 1:
-            # get indexes where the original predictions are incorrect
-            incorrect_idxs = np.array( np.where(prediction.data.max(1)[1].eq(cls).cpu().numpy() == 0))[0].astype(int)
-            skipped += incorrect_idxs.shape[0]
-            no_skipped += (batch_size - incorrect_idxs.shape[0])
-            if incorrect_idxs.shape[0] == batch_size:
-                #print("All original predictions were incorrect! Skipping batch!")
-                continue
-            elif incorrect_idxs.shape[0] > 0 and incorrect_idxs.shape[0] < batch_size:
-                # get indexes of the correct predictions and filter out the incorrect indexes
-                correct_idxs = np.setdiff1d( np.arange(batch_size), incorrect_idxs)
-                correct_idxs = torch.LongTensor(correct_idxs)
-                if opt.cuda:
-                    correct_idxs = correct_idxs.cuda()
-                inputv = torch.index_select(inputv, 0, Variable(correct_idxs)) #inputv updated to now only focus on those correctly predicted by DenseNet
-                prediction = torch.index_select(prediction, 0, Variable(correct_idxs)) #only correct predictions by DenseNet is kept in prediction
-                cls = torch.index_select(cls, 0, correct_idxs)
-
-        # if this is a targeted attack, fill the target variable and filter out examples that are of that target class 
+        prediction = train_logits[idx] #prediction is the set of data that is predicted by the DenseNet (cached clean logits)
+
+        # the sampler only yields correctly classified samples (if restrict_to_correct_preds) that are not
+        # of the target class, so for a targeted attack we only need to fill the target variable
         if opt.targeted == 1:
-            targets.data.resize_as_(cls).fill_(opt.chosen_target_class) 
-            ids = np.array( np.where(targets.data.eq(cls).cpu().numpy() == 0))[0].astype(int)
-            ids = torch.LongTensor(ids)
-            if opt.cuda:
-                ids = ids.cuda()
-            inputv = torch.index_select(inputv, 0, Variable(ids))
-            prediction = torch.index_select(prediction, 0, Variable(ids))
-            cls = torch.index_select(cls, 0, ids)
+            targets.data.fill_(opt.chosen_target_class)
 
         # update sizes
         batch_size = inputv.size(0)
         with torch.no_grad():
-            noise.resize_(batch_size, opt.nz, 1, 1).normal_(0, 0.5)
+            noise.resize_(noise_count(batch_size), opt.nz, 1, 1).normal_(0, 0.5)
         with torch.no_grad():
             targets.resize_(batch_size)
        
         # compute an adversarial example and its prediction 
-        prediction = netClassifier(inputv)
         netClassifier.eval()
         netAttacker.eval()
-        delta = netAttacker(noise)
-        adv_sample_ = delta*c + inputv
-        adv_sample = torch.clamp(adv_sample_, min_val, max_val) 
-        adv_prediction = netClassifier(adv_sample) #adversarial UAN prediction using DenseNet?------------------------------------------------
+        with autocast(device, opt.amp == 1):
+            delta, adv_sample, adv_prediction = attack_step(noise, inputv, c, min_val, max_val) #adversarial UAN prediction using DenseNet?------------------------------------------------
         
         # get indexes of failed adversarial examples, and store in no_idx
         if opt.targeted == 1:
@@ -250,29 +434,20 @@ def train(epoch, c, noise):
         # if there are any adversarial examples, compute distance and update norms, and save image
         if len(no_idx) != inputv.size(0):
             yes_idx = np.setdiff1d(np.array(range(inputv.size(0))), no_idx) #yes_idx is those adversarial examples who have successfully fooled DenseNet
+            record_norms(yes_idx, inputv, adv_sample, L_inf, dist, pert_norm, adv_norm, non_adv_norm)
             for i, adv_idx in enumerate(yes_idx):
                 print(Fore.LIGHTGREEN_EX + 'In training for those UAN successfully fooled DenseNet:  ' + str(i) + str(adv_idx) + ' of batch ' + str(batch_idx)) #code
                 clean = inputv[adv_idx].data.view(1, nc, opt.imageSize ,opt.imageSize) #clean image
                 adv = adv_sample[adv_idx].data.view(1, nc, opt.imageSize, opt.imageSize) #perturbed image
                 pert = (inputv[adv_idx]-adv_sample[adv_idx]).data.view(1, nc, opt.imageSize, opt.imageSize)  #UAN vector = clean - perturbed image 
- 
-                adv_ = rescale(adv_sample[adv_idx], mean=(0.4914, 0.4822, 0.4465), std=(0.2023, 0.1994, 0.2010))
-                clean_ = rescale(inputv[adv_idx], mean=(0.4914, 0.4822, 0.4465), std=(0.2023, 0.1994, 0.2010))
-                
-                linf = torch.max(torch.abs(adv_ - clean_)).data.cpu().numpy() #linf = perturbed image - clean image
-                noise_norm = torch.sqrt(torch.sum( (clean_[:, :, :] - adv_[:, :, :])**2  )).data.cpu().numpy()
-                image_norm = torch.sqrt(torch.sum( clean_[:, :, :]**2 )).data.cpu().numpy()
-                adv_norm_s   = torch.sqrt(torch.sum( adv_[:, :, :]**2 )).data.cpu().numpy()
-                
-                dist.append(noise_norm/image_norm)
-                pert_norm.append(noise_norm)
-                non_adv_norm.append(image_norm)
-                adv_norm.append(adv_norm_s)
-                L_inf.append(linf)
 
                 if batch_idx == 0: #batch_idx of trainset - why only 1 batch id? Code suggestion: Remove this, save for all batches
                     #only for training set, consider using similar method for test--------------------------------------------
-                    vutils.save_image(torch.cat((clean,pert,adv)), './{}/{}_{}.png'.format(opt.outf, epoch, i), normalize=True, scale_each=True)
+                    if opt.dump_format == 'packed':
+                        writer.dump_packed(archive, clean, pert, adv, split='train', epoch=epoch, batch_idx=batch_idx, sample=int(adv_idx),
+                                           cls=cls[adv_idx].item(), pred=prediction[adv_idx].argmax().item(), adv_pred=adv_prediction[adv_idx].argmax().item())
+                    else:
+                        writer.dump([(torch.cat((clean,pert,adv)), './{}/{}_{}.png'.format(opt.outf, epoch, i))])
                     #could only 1 i being produced mean only 1 image is successfully fooled?
 
         # if opt.optimize_on_success == 0, we do not optimize on already successfully computed adversarial examples
@@ -280,9 +455,7 @@ def train(epoch, c, noise):
         if opt.optimize_on_success == 0:
             if len(no_idx)!=0:  
                 # select the non adv examples to optimise on 
-                no_idx = torch.LongTensor(no_idx)
-                if opt.cuda:
-                    no_idx = no_idx.cuda()
+                no_idx = torch.LongTensor(no_idx).to(device)
                 no_idx = Variable(no_idx)
                 #updating all values for those not successfully fooled
                 inputv = torch.index_select(inputv, 0, no_idx)
@@ -297,38 +470,20 @@ def train(epoch, c, noise):
         elif opt.optimize_on_success == 1:
             yes_idx = np.setdiff1d(np.arange(batch_size), no_idx)
             if yes_idx.shape[0]!=0:
-                adv_prediction_succ = adv_prediction[torch.LongTensor(yes_idx).cuda()]
-                prediction_succ = prediction[torch.LongTensor(yes_idx).cuda()].data.max(1)[1]
-                adv_prediction_succ = F.softmax(adv_prediction_succ)
+                yes = torch.LongTensor(yes_idx).to(device)
+                success_loss = attack_model.success_loss(adv_prediction[yes], prediction[yes].argmax(1))
                 if no_idx.shape[0]!=0:
-                    adv_prediction = adv_prediction[torch.LongTensor(no_idx).cuda()]
-                adv_pred_idx = torch.FloatTensor([x[prediction_succ[i]].data[0] for i, x in enumerate(adv_prediction_succ)]).cuda()
-                adv_max_idx = adv_prediction_succ.data.max(1)[0]
-                success_loss = -torch.mean( torch.log(adv_max_idx)-torch.log(adv_pred_idx) )
+                    adv_prediction = adv_prediction[torch.LongTensor(no_idx).to(device)]
             else:
                 success_loss = 0
 
         if len(no_idx)!=0:
-            # compute loss and backprop
-            adv_prediction_softmax = F.softmax(adv_prediction) #adv_predictions are predictions using DenseNet on those that failed to fool
-            #adv_prediction_np = adv_prediction.data.cpu().numpy()
-            adv_prediction_np = adv_prediction_softmax.data.cpu().numpy()
-            curr_adv_label = Variable(torch.LongTensor( np.array( [arr.argsort()[-1] for arr in adv_prediction_np] ) ) )
-            #prediction labels?---------------------------------------------------------------------------   
-            if opt.targeted == 1:
-                targ_adv_label = Variable(torch.LongTensor( np.array( [targets.data[i] for i, arr in enumerate(adv_prediction_np)] ) ) )
-            else:
-                targ_adv_label = Variable(torch.LongTensor( np.array( [arr.argsort()[-2] for arr in adv_prediction_np] ) ) )
-            if opt.cuda:
-                curr_adv_label = curr_adv_label.cuda()
-                targ_adv_label = targ_adv_label.cuda()
-            curr_adv_pred = adv_prediction_softmax.gather(1, curr_adv_label.unsqueeze(1))
-            targ_adv_pred = adv_prediction_softmax.gather(1, targ_adv_label.unsqueeze(1))
+            # compute loss and backprop: log p(top-1) - log p(target) of the samples that failed to fool,
+            # with the target being the top-2 class (untargeted) or the chosen class (targeted)
+            targ_adv_label = targets[:adv_prediction.size(0)] if opt.targeted == 1 else None
+            classifier_loss = attack_model.margin_loss(adv_prediction, targ_adv_label)
             if opt.optimize_on_success == 1:
-                 classifier_loss = torch.mean( torch.log(curr_adv_pred)-torch.log(targ_adv_pred) ) + success_loss
-            else:
-                 classifier_loss = torch.mean( torch.log(curr_adv_pred)-torch.log(targ_adv_pred) )
-                 #classifier_loss = size of those not successfully fooled
+                 classifier_loss = classifier_loss + success_loss
 
             if opt.norm == 'linf':
                 ldist_loss = opt.ldist_weight*torch.max(torch.abs(adv_sample - inputv)) #ldist loss = adversarial image - origianl image
@@ -338,102 +493,76 @@ def train(epoch, c, noise):
                 print("Please define a norm (l2 or linf)")
                 exit()
             loss = classifier_loss + ldist_loss 
-            loss.backward()
-            optimizerAttacker.step()
-            c_loss.append(classifier_loss.data.item())
+            scaler.scale(loss).backward()
+            if batch_idx == 0 and epoch == 1:
+                check_only_trainable_grads(netAttacker, netClassifier)
+            scaler.step(optimizerAttacker)
+            scaler.update()
+            c_loss.update(classifier_loss.data.item())
         else:
             if opt.optimize_on_success == 1:
                 classifier_loss = success_loss
-                c_loss.append(classifier_loss)
-                classifier_loss = torch.FloatTensor([classifier_loss])
-                classifier_loss = Variable(classifier_loss, requires_grad=True)
-                if opt.cuda:
-                    classifier_loss = classifier_loss.cuda()
-                loss.backward()
-                optimizerAttacker.step()
+                c_loss.update(classifier_loss.item())
+                loss = classifier_loss
+                scaler.scale(loss).backward()
+                scaler.step(optimizerAttacker)
+                scaler.update()
             else:
-                c_loss.append(0)
+                c_loss.update(0)
             
         # log to file,  saving for each batch
-        progress_bar(batch_idx, len(trainloader), "Tr E%s, C_L %.5f A_Succ %.5f L_inf %.5f L2 %.5f (Pert %.2f, Adv %.2f, Clean %.2f) C %.6f Skipped %.1f%%" %(epoch, np.mean(c_loss), success_count/total_count, np.mean(L_inf), np.mean(dist), np.mean(pert_norm), np.mean(adv_norm), np.mean(non_adv_norm), c, 100*(skipped/(skipped+no_skipped)))) 
+        stats = (c_loss.mean, success_count/total_count, L_inf.mean, dist.mean, pert_norm.mean, adv_norm.mean, non_adv_norm.mean, c, 100*(skipped/(skipped+no_skipped)))
+        progress_bar(batch_idx, len(trainloader), "Tr E%s, C_L %.5f A_Succ %.5f L_inf %.5f L2 %.5f (Pert %.2f, Adv %.2f, Clean %.2f) C %.6f Skipped %.1f%%" %((epoch,) + stats)) 
         #batch id, length of trainset, epoch, classifier loss of those not fooled (not successful), % successfully perturbed, loss of those successfully fooled, -distance, -pert norm, -adv norm, -non_adv norm, c (scale of perturbation), skipped % where the original predictions are incorrect (attack not done)
-        WriteToFile('./%s/log' %(opt.outf),  "Tr Epoch %s batch_idx %s C_L %.5f A_Succ %.5f L_inf %.5f L2 %.5f (Pert %.2f, Adv %.2f, Clean %.2f) C %.6f Skipped %.1f%%" %(epoch, batch_idx, np.mean(c_loss), success_count/total_count, np.mean(L_inf), np.mean(dist), np.mean(pert_norm), np.mean(adv_norm), np.mean(non_adv_norm), c, 100*(skipped/(skipped+no_skipped))))
+        logger.log('train', epoch=epoch, batch_idx=batch_idx, **dict(zip(TRAIN_FIELDS, stats)))
+
+        if opt.c_search == 1 and (batch_idx + 1) % opt.c_search_every == 0:
+            c = search_c(c, epoch, batch_idx, heldout)
 
     # save attack model weights with its epoch 
     if epoch % opt.every == 0:
         torch.save(netAttacker.state_dict(), '%s/netAttacker_%s.pth' % (opt.outf, epoch))
 
-    return success_count/total_count, np.mean(L_inf), np.mean(dist)
-    # % successfully perturbed, loss of those successfully fooled, -distance
+    log_histograms('Tr', epoch, L_inf, dist)
+    log_timing('Tr', epoch, trainloader, total_count, time.time() - start)
+    logger.flush()
+    return success_count/total_count, L_inf.mean, dist.mean, c
+    # % successfully perturbed, loss of those successfully fooled, -distance, c (changed within the epoch by --c_search)
 
 def test(epoch, c, noise):
     netAttacker.eval()
     netClassifier.eval()
-    L_inf = [ ]
-    L2 = [ ]
-    pert_norm = [ ]
-    dist = [ ]
-    adv_norm = [ ]
-    non_adv_norm = [ ]
+    _, L_inf, pert_norm, dist, adv_norm, non_adv_norm = new_stats()
     total_count = 0
     success_count = 0
-    skipped = 0
-    no_skipped = 0
-    for batch_idx, (inputv, cls) in enumerate(testloader):
-        if opt.cuda:
-            inputv = inputv.cuda()
-        inputv = Variable(inputv)
+    writer.new_epoch()
+    skipped = test_skipped
+    no_skipped = len(test_logits) - test_skipped
+    fp32_success_count = 0
+    start = time.time()
+    for batch_idx, (inputv, cls, idx) in enumerate(testloader):
+        inputv = Variable(to_input(inputv.to(device, non_blocking=pin_memory)))
         batch_size = inputv.size(0)
  
-        targets = torch.LongTensor(batch_size)
-        if opt.cuda:
-            targets = targets.cuda()
-            cls = cls.cuda()
+        targets = torch.LongTensor(batch_size).to(device)
+        cls = cls.to(device, non_blocking=pin_memory)
         targets = Variable(targets)
         
-        prediction = netClassifier(inputv) #prediction is the set of data that is predicted by the DenseNet
+        prediction = test_logits[idx] #prediction is the set of data that is predicted by the DenseNet (cached clean logits)
         
-        # only computer adversarial examples on examples that are originally classified correctly 
-        if opt.restrict_to_correct_preds == 1:
-            # get indexes where the original predictions are incorrect
-            incorrect_idxs = np.array( np.where(prediction.data.max(1)[1].eq(cls).cpu().numpy() == 0))[0].astype(int)
-            skipped += incorrect_idxs.shape[0]
-            no_skipped += (batch_size - incorrect_idxs.shape[0])
-            if incorrect_idxs.shape[0] == batch_size:
-                print("All original predictions were incorrect! Skipping batch!")
-                continue
-            elif incorrect_idxs.shape[0] > 0 and incorrect_idxs.shape[0] < batch_size:
-                # get indexes of the correct predictions and filter out the incorrect indexes
-                correct_idxs = np.setdiff1d( np.arange(batch_size), incorrect_idxs)
-                correct_idxs = torch.LongTensor(correct_idxs)
-                if opt.cuda:
-                    correct_idxs = correct_idxs.cuda()
-                inputv = torch.index_select(inputv, 0, Variable(correct_idxs)) #inputv updated to now only focus on those correctly predicted by DenseNet
-                prediction = torch.index_select(prediction, 0, Variable(correct_idxs)) #only correct predictions by DenseNet is kept in prediction
-                cls = torch.index_select(cls, 0, correct_idxs)
-        # remove samples that are of the target class
+        # incorrect predictions and samples of the target class are already excluded by the sampler
         if opt.targeted == 1:
-            targets.data.resize_as_(cls).fill_(opt.chosen_target_class) 
-            ids = np.array( np.where(targets.data.eq(cls).cpu().numpy() == 0))[0].astype(int)
-            ids = torch.LongTensor(ids)
-            if opt.cuda:
-                ids = ids.cuda()
-            inputv = torch.index_select(inputv, 0, Variable(ids))
-            prediction = torch.index_select(prediction, 0, Variable(ids))
-            cls = torch.index_select(cls, 0, ids)
+            targets.data.fill_(opt.chosen_target_class)
 
         batch_size = inputv.size(0)
         with torch.no_grad():
-            noise.resize_(batch_size, opt.nz, 1, 1).normal_(0, 0.5)
+            noise.resize_(noise_count(batch_size), opt.nz, 1, 1).normal_(0, 0.5)
         with torch.no_grad():
             targets.resize_(batch_size)
         
          # compute an adversarial example and its prediction
-        prediction = netClassifier(inputv)
-        delta = netAttacker(noise)
-        adv_sample_ = delta*c + inputv
-        adv_sample = torch.clamp(adv_sample_, min_val, max_val) 
-        adv_prediction = netClassifier(adv_sample) #adversarial UAN prediction using DenseNet?------------------------------------------------
+        with autocast(device, opt.amp == 1):
+            delta, adv_sample, adv_prediction = attack_step(noise, inputv, c, min_val, max_val) #adversarial UAN prediction using DenseNet?------------------------------------------------
         
         # get indexes of failed adversarial examples, and store in no_idx
         if opt.targeted == 1:
@@ -441,6 +570,15 @@ def test(epoch, c, noise):
         else:
             no_idx = np.array( np.where(adv_prediction.data.max(1)[1].eq(prediction.data.max(1)[1]).cpu().numpy() == 1))[0].astype(int)
 
+        if opt.amp == 1 and opt.amp_compare == 1:
+            # the same attack in fp32, to see how much autocast changes the success rate
+            with torch.no_grad():
+                adv_pred32 = attack_step(noise, inputv, c, min_val, max_val)[2].argmax(1)
+            if opt.targeted == 1:
+                fp32_success_count += adv_pred32.eq(targets).sum().item()
+            else:
+                fp32_success_count += adv_pred32.ne(prediction.argmax(1)).sum().item()
+
         # update success and total counts
         success_count += inputv.size(0) - len(no_idx)
         total_count += inputv.size(0)
@@ -448,53 +586,62 @@ def test(epoch, c, noise):
         # if there are any adversarial examples, compute distance and update norms, and save image   
         if len(no_idx) != inputv.size(0):
             yes_idx = np.setdiff1d(np.array(range(inputv.size(0))), no_idx) #yes_idx is those adversarial examples who have successfully fooled DenseNet
+            record_norms(yes_idx, inputv, adv_sample, L_inf, dist, pert_norm, adv_norm, non_adv_norm)
+
+            # the per-sample report comes from the batch predictions, moved to the host once per batch
+            yes = torch.LongTensor(yes_idx).to(device)
+            clean_logits = prediction.index_select(0, yes).detach().float().cpu()
+            adv_logits = adv_prediction.index_select(0, yes).detach().float().cpu()
+            clean_pred, adv_pred = clean_logits.argmax(1), adv_logits.argmax(1)
+            yes_cls = cls.index_select(0, yes).cpu()
+            if opt.recheck == 1:
+                # re-classify all the fooled samples of the batch in one forward
+                with torch.no_grad():
+                    recheck_pred = netClassifier(adv_sample.index_select(0, yes)).argmax(1).cpu()
+                mismatches = recheck_pred.ne(adv_pred).sum().item()
+                if mismatches > 0:
+                    print(Fore.LIGHTRED_EX + 'recheck: %d of %d perturbed predictions changed in batch %s' % (mismatches, len(yes_idx), batch_idx))
+
             for i, adv_idx in enumerate(yes_idx):
                 print(Fore.LIGHTGREEN_EX + 'In test for those UAN successfully fooled DenseNet:  ' + str(i) + str(adv_idx) + ' of batch ' + str(batch_idx)) #code
                 clean = inputv[adv_idx].data.view(1, nc, opt.imageSize ,opt.imageSize) #clean image
                 adv = adv_sample[adv_idx].data.view(1, nc, opt.imageSize, opt.imageSize) #perturbed image
                 pert = (inputv[adv_idx]-adv_sample[adv_idx]).data.view(1, nc, opt.imageSize, opt.imageSize)  #UAN vector = clean - perturbed image 
 
-                adv_ = rescale(adv_sample[adv_idx], mean=(0.4914, 0.4822, 0.4465), std=(0.2023, 0.1994, 0.2010))
-                clean_ = rescale(inputv[adv_idx], mean=(0.4914, 0.4822, 0.4465), std=(0.2023, 0.1994, 0.2010))
-                
-                linf = torch.max(torch.abs(adv_ - clean_)).data.cpu().numpy() #linf = perturbed image - clean image
-                noise_norm = torch.sqrt(torch.sum( (clean_[:, :, :] - adv_[:, :, :])**2  )).data.cpu().numpy()
-                image_norm = torch.sqrt(torch.sum( clean_[:, :, :]**2 )).data.cpu().numpy()
-                adv_norm_s   = torch.sqrt(torch.sum( adv_[:, :, :]**2 )).data.cpu().numpy()
-                
-                dist.append(noise_norm/image_norm)
-                pert_norm.append(noise_norm)
-                non_adv_norm.append(image_norm)
-                adv_norm.append(adv_norm_s)
-                L_inf.append(linf)
-                
-                #if batch_idx <= 20:
-                    #for i, adv_idx in enumerate(batch_idx):
-                        #try to get predictions of clean ------------------------------------
-            
-                prediction = netClassifier(clean)
-                print(Fore.LIGHTCYAN_EX + 'clean prediction: ' + str(prediction) + ' --------------------------------')
-                vutils.save_image(clean, './{}/{}_{}_clean.png'.format('classifications', batch_idx, i), normalize=True, scale_each=True)
-                WriteToFile('./%s/classifications' %(opt.outf),  " Original prediction of clean for batch idx %s : %s, with predicted class %s" %(batch_idx, prediction,prediction.data.max(1)[1]))
-                
-                #try to get prediction of perturbed ----------------------------------
-                adv_prediction = netClassifier(adv)
-                print(Fore.LIGHTRED_EX + 'perturbed prediction: ' + str(adv_prediction) + ' --------------------------------')
-                vutils.save_image(adv, './{}/{}_{}_perturbed.png'.format('classifications', batch_idx, i), normalize=True, scale_each=True)
-                WriteToFile('./%s/classifications' %(opt.outf),  "Perturbed prediction of perturbed image for batch idx %s : %s with predicted class %s" %(batch_idx, adv_prediction, adv_prediction.data.max(1)[1]))
-                vutils.save_image(torch.cat((clean,pert,adv)), './{}/{}_{}combined.png'.format('classifications', batch_idx, i), normalize=True, scale_each=True)
+                print(Fore.LIGHTCYAN_EX + 'clean prediction: %s (class %d) --------------------------------' % (clean_logits[i].tolist(), clean_pred[i]))
+                logger.log('classification', epoch=epoch, batch_idx=batch_idx, sample=i, image='clean', logits=clean_logits[i], pred=clean_pred[i])
+                print(Fore.LIGHTRED_EX + 'perturbed prediction: %s (class %d) --------------------------------' % (adv_logits[i].tolist(), adv_pred[i]))
+                logger.log('classification', epoch=epoch, batch_idx=batch_idx, sample=i, image='perturbed', logits=adv_logits[i], pred=adv_pred[i])
+                if opt.dump_format == 'packed':
+                    writer.dump_packed(archive, clean, pert, adv, split='test', epoch=epoch, batch_idx=batch_idx, sample=int(adv_idx),
+                                       cls=yes_cls[i].item(), pred=clean_pred[i].item(), adv_pred=adv_pred[i].item())
+                else:
+                    writer.dump([(clean, './{}/{}_{}_clean.png'.format('classifications', batch_idx, i)),
+                                 (adv, './{}/{}_{}_perturbed.png'.format('classifications', batch_idx, i)),
+                                 (torch.cat((clean,pert,adv)), './{}/{}_{}combined.png'.format('classifications', batch_idx, i))])
                 
         #no image saved here, unlike train ---------------------------------------------------------------------------------------------------------        
-        progress_bar(batch_idx, len(testloader), "Val E%s, A_Succ %.5f L_inf %.5f L2 %.5f (Pert %.2f, Adv %.2f, Clean %.2f) C %.6f Skipped %.1f%%" %(epoch, success_count/total_count, np.mean(L_inf), np.mean(dist), np.mean(pert_norm), np.mean(adv_norm), np.mean(non_adv_norm), c, 100*(skipped/(skipped+no_skipped)))) 
+        stats = (success_count/total_count, L_inf.mean, dist.mean, pert_norm.mean, adv_norm.mean, non_adv_norm.mean, c, 100*(skipped/(skipped+no_skipped)))
+        progress_bar(batch_idx, len(testloader), "Val E%s, A_Succ %.5f L_inf %.5f L2 %.5f (Pert %.2f, Adv %.2f, Clean %.2f) C %.6f Skipped %.1f%%" %((epoch,) + stats)) 
         #batch id, length of testset, epoch, % successfully perturbed, loss of those successfully fooled, -distance, -pert norm, -adv norm, -non_adv norm, c (scale of perturbation), skipped % where the original predictions are incorrect (attack not done) should not be skipped for test
-        WriteToFile('./%s/log' %(opt.outf),  "Val Epoch %s batch_idx %s A_Succ %.5f L_inf %.5f L2 %.5f (Pert %.2f, Adv %.2f, Clean %.2f) C %.6f Skipped %.1f%%" %(epoch, batch_idx, success_count/total_count, np.mean(L_inf), np.mean(dist), np.mean(pert_norm), np.mean(adv_norm), np.mean(non_adv_norm), c, 100*(skipped/(skipped+no_skipped))))
+        logger.log('val', epoch=epoch, batch_idx=batch_idx, **dict(zip(VAL_FIELDS, stats)))
+    log_histograms('Val', epoch, L_inf, dist)
+    log_timing('Val', epoch, testloader, total_count, time.time() - start)
+    if opt.amp == 1 and opt.amp_compare == 1:
+        print('Val E%s A_Succ amp %.5f fp32 %.5f (diff %+.5f)' % (epoch, success_count/total_count, fp32_success_count/total_count,
+                                                                (success_count - fp32_success_count)/total_count))
+        logger.log('amp_compare', epoch=epoch, success=success_count/total_count, success_fp32=fp32_success_count/total_count)
+    logger.flush()
 
 
 if __name__ == '__main__':
 
     c = opt.shrink
-    min_val, max_val = find_boundaries(trainloader)
+    min_val, max_val = clamp_boundaries()
     print(min_val, max_val)
+    logger.log('bounds', min_val=min_val, max_val=max_val, mean=norm_mean, std=norm_std)
+    # loaded (and decoded) once, then reused by every c search of every epoch
+    heldout = heldout_batch() if opt.c_search == 1 else None
     if not os.path.isdir('checkpoint'):
         os.mkdir('checkpoint')
     if not os.path.isdir('classifications'):
@@ -504,7 +651,7 @@ if __name__ == '__main__':
     for epoch in range(1, opt.epochs + 1):
         print('epoch: ' + str(epoch))
         start = time.time()
-        score, linf, l2 = train(epoch, c, noise)
+        score, linf, l2, c = train(epoch, c, noise)
         # % successfully perturbed, loss of those successfully fooled, -distance
         if linf > opt.max_norm:
             print(Fore.LIGHTCYAN_EX + 'debug: loss > max allowed perturbation in train -----------------')
@@ -521,9 +668,14 @@ if __name__ == '__main__':
         if epoch % 2 == 0:
             prev_pred = curr_pred
             curr_pred = score
-        if epoch > 2:
+        if epoch > 2 and opt.c_search == 0:
             if ( prev_pred - curr_pred ) >= 0:
                 c += opt.shrink_inc
     torch.save(netAttacker.state_dict(), '%s/netAttacker_%s.pth' % (opt.outf, epoch))
+    logger.log('final', epoch=epoch, c=c, netAttacker='%s/netAttacker_%s.pth' % (opt.outf, epoch))
     test(epoch, c, noise)
+    writer.close()
+    if archive is not None:
+        archive.close()
+    logger.close()
     
@@ -0,0 +1,64 @@
+'''Perturbation metrics for a whole batch of adversarial examples, and running aggregates of them.
+
+All norms are measured on the un-normalized images (what rescale() used to give
+per sample), computed in one pass on the device, without touching the inputs.
+RunningStat accumulates them (and the losses) over an epoch without keeping
+every value around.
+'''
+import numpy as np
+import torch
+
+
+def unnormalize(batch, mean, std):
+    '''New tensor with transforms.Normalize(mean, std) undone on an NCHW batch.'''
+    mean = torch.as_tensor(mean, dtype=batch.dtype, device=batch.device).view(1, -1, 1, 1)
+    std = torch.as_tensor(std, dtype=batch.dtype, device=batch.device).view(1, -1, 1, 1)
+    return batch * std + mean
+
+
+def perturbation_norms(clean, adv, mean, std):
+    '''Per-sample (L_inf, L2 of the perturbation, L2 of the clean image, L2 of the adversarial image).
+
+    Returns an N x 4 float tensor on the inputs' device; move it to the host once per batch.
+    '''
+    with torch.no_grad():
+        clean_ = unnormalize(clean.detach().float(), mean, std).flatten(1)
+        adv_ = unnormalize(adv.detach().float(), mean, std).flatten(1)
+        diff = adv_ - clean_
+        return torch.stack([diff.abs().max(1)[0], diff.norm(dim=1), clean_.norm(dim=1), adv_.norm(dim=1)], 1)
+
+
+class RunningStat(object):
+    '''Running count, mean and max of a stream of values, with O(1) memory.
+
+    With bins > 0 it also keeps a fixed-size histogram of the values over [lo, hi]
+    (values outside the range are counted in the first/last bin).
+    '''
+
+    def __init__(self, bins=0, lo=0., hi=1.):
+        self.count = 0
+        self.total = 0.
+        self.max = float('nan')
+        self.lo, self.hi = lo, hi
+        self.hist = np.zeros(bins, dtype=np.int64) if bins > 0 else None
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        if values.size == 0:
+            return
+        self.count += values.size
+        self.total += values.sum()
+        self.max = values.max() if self.count == values.size else max(self.max, values.max())
+        if self.hist is not None:
+            self.hist += np.histogram(np.clip(values, self.lo, self.hi), bins=len(self.hist), range=(self.lo, self.hi))[0]
+
+    @property
+    def mean(self):
+        # nan for an empty stream, like np.mean([])
+        return self.total / self.count if self.count else float('nan')
+
+    def histogram(self):
+        '''(bin edges, counts), or None without bins.'''
+        if self.hist is None:
+            return None
+        return np.linspace(self.lo, self.hi, len(self.hist) + 1), self.hist.copy()
@@ -1,9 +1,19 @@
-'''DenseNet in PyTorch.'''
+'''DenseNet in PyTorch.
+
+With memory_efficient=True each dense block keeps its layers' new features in a
+list instead of concatenating them after every layer, and the concat + BN-ReLU-conv1
+bottleneck is recomputed during backward (gradient checkpointing). Activation memory
+then grows linearly instead of quadratically within a block, for one extra
+bottleneck forward per layer. The parameters and state_dict are unchanged.
+Recomputing runs BatchNorm twice, so use it with the model in eval mode (as the
+attack does) or accept the extra running-stat update.
+'''
 import math
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint as cp
 
 from torch.autograd import Variable
 
@@ -22,6 +32,17 @@ class Bottleneck(nn.Module):
         out = torch.cat([out,x], 1)
         return out
 
+    def _bottleneck(self, *features):
+        return self.conv1(F.relu(self.bn1(torch.cat(features, 1))))
+
+    def new_features(self, features):
+        '''Only the growth_rate new channels, from the list of earlier features (newest first).'''
+        if torch.is_grad_enabled() and any(f.requires_grad for f in features):
+            out = cp.checkpoint(self._bottleneck, *features, use_reentrant=False)
+        else:
+            out = self._bottleneck(*features)
+        return self.conv2(F.relu(self.bn2(out)))
+
 
 class Transition(nn.Module):
     def __init__(self, in_planes, out_planes):
@@ -36,9 +57,10 @@ class Transition(nn.Module):
 
 
 class DenseNet(nn.Module):
-    def __init__(self, block, nblocks, growth_rate=12, reduction=0.5, num_classes=4):
+    def __init__(self, block, nblocks, growth_rate=12, reduction=0.5, num_classes=4, memory_efficient=False):
         super(DenseNet, self).__init__()
         self.growth_rate = growth_rate
+        self.memory_efficient = memory_efficient
 
         num_planes = 2*growth_rate
         self.conv1 = nn.Conv2d(3, num_planes, kernel_size=3, padding=1, bias=False)
@@ -74,31 +96,40 @@ class DenseNet(nn.Module):
             in_planes += self.growth_rate
         return nn.Sequential(*layers)
 
+    def _dense(self, block, x):
+        if not self.memory_efficient:
+            return block(x)
+        # same channel order as the chained torch.cat([out,x], 1): newest features first
+        features = [x]
+        for layer in block:
+            features.insert(0, layer.new_features(features))
+        return torch.cat(features, 1)
+
     def forward(self, x):
         out = self.conv1(x)
-        out = self.trans1(self.dense1(out))
-        out = self.trans2(self.dense2(out))
-        out = self.trans3(self.dense3(out))
-        out = self.dense4(out)
+        out = self.trans1(self._dense(self.dense1, out))
+        out = self.trans2(self._dense(self.dense2, out))
+        out = self.trans3(self._dense(self.dense3, out))
+        out = self._dense(self.dense4, out)
         out = F.avg_pool2d(F.relu(self.bn(out)), 4)
         out = out.view(out.size(0), -1)
         out = self.linear(out)
         return out
 
-def DenseNet121():
-    return DenseNet(Bottleneck, [6,12,24,16], growth_rate=32)
+def DenseNet121(memory_efficient=False):
+    return DenseNet(Bottleneck, [6,12,24,16], growth_rate=32, memory_efficient=memory_efficient)
 
-def DenseNet169():
-    return DenseNet(Bottleneck, [6,12,32,32], growth_rate=32)
+def DenseNet169(memory_efficient=False):
+    return DenseNet(Bottleneck, [6,12,32,32], growth_rate=32, memory_efficient=memory_efficient)
 
-def DenseNet201():
-    return DenseNet(Bottleneck, [6,12,48,32], growth_rate=32)
+def DenseNet201(memory_efficient=False):
+    return DenseNet(Bottleneck, [6,12,48,32], growth_rate=32, memory_efficient=memory_efficient)
 
-def DenseNet161():
-    return DenseNet(Bottleneck, [6,12,36,24], growth_rate=48)
+def DenseNet161(memory_efficient=False):
+    return DenseNet(Bottleneck, [6,12,36,24], growth_rate=48, memory_efficient=memory_efficient)
 
-def densenet_cifar():
-    return DenseNet(Bottleneck, [6,12,24,16], growth_rate=12)
+def densenet_cifar(memory_efficient=False):
+    return DenseNet(Bottleneck, [6,12,24,16], growth_rate=12, memory_efficient=memory_efficient)
 
 def test_densenet():
     net = densenet_cifar()
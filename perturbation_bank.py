@@ -0,0 +1,94 @@
+'''NumPy-only runtime for an exported perturbation bank.
+
+export_bank.py samples deltas from a trained netAttacker, scales them by the
+final c and writes them to <path>.npy. They are stored as uint8 (per-channel
+affine quantization) or float16. The normalization constants, the clamp bounds
+and the quantization parameters go into <path>.json. Applying the bank needs
+only NumPy and a memory-mapped load, so no PyTorch install or generator
+checkpoint is involved:
+
+    bank = PerturbationBank('resnet-results/bank')
+    adv = bank.apply(images)        # uint8 NCHW RGB batch -> normalized adversarial batch
+    pixels = bank.to_uint8(adv)     # back to uint8 images
+
+By default image i of a batch gets delta i mod len(bank); pass index (e.g.
+np.random.randint(len(bank), size=n)) to choose them yourself.
+'''
+import json
+
+import numpy as np
+
+
+def bank_paths(path):
+    '''(deltas .npy, metadata .json) of the bank at path.'''
+    return path + '.npy', path + '.json'
+
+
+def quantize(deltas, dtype='uint8'):
+    '''(stored array, metadata) for float32 N x C x H x W deltas, as uint8 per channel or float16.'''
+    if dtype == 'float16':
+        return deltas.astype(np.float16), {'dtype': 'float16'}
+    if dtype != 'uint8':
+        raise ValueError("unknown bank dtype '%s' (uint8 or float16)" % dtype)
+    lo = deltas.min(axis=(0, 2, 3)).reshape(1, -1, 1, 1)
+    hi = deltas.max(axis=(0, 2, 3)).reshape(1, -1, 1, 1)
+    scale = np.maximum(hi - lo, 1e-12) / 255.
+    stored = np.clip(np.rint((deltas - lo) / scale), 0, 255).astype(np.uint8)
+    return stored, {'dtype': 'uint8', 'scale': scale.ravel().tolist(), 'offset': lo.ravel().tolist()}
+
+
+def write_bank(path, deltas, dtype='uint8', **meta):
+    '''Quantize deltas and write the bank; meta must hold mean, std, min_val and max_val.'''
+    stored, quant = quantize(np.asarray(deltas, dtype=np.float32), dtype)
+    meta.update(quant)
+    meta['count'], meta['shape'] = int(stored.shape[0]), list(stored.shape[1:])
+    npy, meta_path = bank_paths(path)
+    np.save(npy, stored)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+class PerturbationBank(object):
+    '''Exported deltas (normalized-input space, already scaled by c) applied to image batches.'''
+
+    def __init__(self, path, mmap=True):
+        npy, meta_path = bank_paths(path)
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+        self.deltas = np.load(npy, mmap_mode='r' if mmap else None)
+        mean = np.asarray(self.meta['mean'], dtype=np.float32).reshape(1, -1, 1, 1)
+        std = np.asarray(self.meta['std'], dtype=np.float32).reshape(1, -1, 1, 1)
+        # pixel p in [0, 255] -> (p / 255 - mean) / std, as one multiply-add (see batch_transforms.BatchAdapter)
+        self.weight = 1. / (255. * std)
+        self.bias = -mean / std
+        self.min_val, self.max_val = self.meta['min_val'], self.meta['max_val']
+        if self.meta['dtype'] == 'uint8':
+            self.scale = np.asarray(self.meta['scale'], dtype=np.float32).reshape(1, -1, 1, 1)
+            self.offset = np.asarray(self.meta['offset'], dtype=np.float32).reshape(1, -1, 1, 1)
+
+    def __len__(self):
+        return self.deltas.shape[0]
+
+    def deltas_for(self, index):
+        '''float32 deltas for the bank rows in index.'''
+        deltas = np.asarray(self.deltas[index], dtype=np.float32)
+        if self.meta['dtype'] == 'uint8':
+            deltas *= self.scale
+            deltas += self.offset
+        return deltas
+
+    def apply(self, images, index=None):
+        '''Normalized, clamped adversarial batch for uint8 (or [0, 1] float) NCHW RGB images.'''
+        images = np.asarray(images)
+        if index is None:
+            index = np.arange(images.shape[0]) % len(self)
+        weight = self.weight if images.dtype == np.uint8 else self.weight * 255.
+        out = images.astype(np.float32) * weight + self.bias
+        out += self.deltas_for(index)
+        return np.clip(out, self.min_val, self.max_val, out=out)
+
+    def to_uint8(self, batch):
+        '''uint8 pixels of a normalized batch (e.g. the output of apply).'''
+        pixels = (batch - self.bias) / self.weight
+        return np.clip(np.rint(pixels), 0, 255).astype(np.uint8)
@@ -0,0 +1,140 @@
+'''Post-training static int8 version of the target classifier, for CPU evaluation.
+
+Evaluating an attack only needs forward passes of the frozen classifier, so on
+CPU it can run in int8. quantize_classifier uses FX graph mode quantization
+with the default qconfig of the x86 (or fbgemm) backend: per-tensor
+activations and per-channel weights for the convolutions and the final
+Linear. Observers are calibrated on batches of data/train, then the model is
+converted, traced and cached next to the checkpoint like the frozen classifier.
+Quantized ops have no gradient, so the attacker is still trained against the
+float classifier. This path is only for evaluation.
+
+Run from the command line, it attacks data/test with the generator of a
+training run, at the run's final c and with its normalization and clamp bounds
+(see eval_setup.py). fp32 and int8 see the same perturbations, and it prints
+clean accuracy, attack success rate and throughput for each:
+
+    python quantized_classifier.py --outf resnet-results
+'''
+import os
+import copy
+import time
+
+import torch
+import torch.utils.data
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from clean_preds import file_hash
+
+
+def quantized_backend():
+    '''Best available quantized engine on this CPU: x86, else fbgemm, else qnnpack.'''
+    engines = torch.backends.quantized.supported_engines
+    for backend in ('x86', 'fbgemm', 'qnnpack'):
+        if backend in engines:
+            return backend
+    raise RuntimeError('no quantized engine available (supported: %s)' % engines)
+
+
+def quantized_path(checkpoint_path, imageSize, calib_batches, backend):
+    '''Where the int8 classifier of checkpoint_path at imageSize is cached.'''
+    return '%s.int8_%s_%s_%d_%d.pt' % (os.path.splitext(checkpoint_path)[0], backend, file_hash(checkpoint_path),
+                                       imageSize, calib_batches)
+
+
+def quantize_classifier(net, calib_loader, imageSize, transform=None, calib_batches=32, backend='x86'):
+    '''int8 copy of net (eval mode, CPU), calibrated on up to calib_batches batches of calib_loader.'''
+    torch.backends.quantized.engine = backend
+    net = copy.deepcopy(net).cpu().eval()
+    example = (torch.randn(1, 3, imageSize, imageSize),)
+    prepared = prepare_fx(net, get_default_qconfig_mapping(backend), example)
+    with torch.no_grad():
+        for i, batch in enumerate(calib_loader):
+            if i >= calib_batches:
+                break
+            inputs = batch[0]
+            if transform is not None:
+                inputs = transform(inputs)
+            prepared(inputs)
+    return convert_fx(prepared)
+
+
+def load_quantized_classifier(net, checkpoint_path, calib_dataset, imageSize, transform=None,
+                              batch_size=64, calib_batches=32, workers=2):
+    '''Traced int8 version of net, loaded from the cache or calibrated on calib_dataset.'''
+    backend = quantized_backend()
+    torch.backends.quantized.engine = backend
+    path = quantized_path(checkpoint_path, imageSize, calib_batches, backend)
+    if os.path.exists(path):
+        print('=> loading int8 classifier from %s' % path)
+        return torch.jit.load(path, map_location='cpu')
+
+    print('=> calibrating int8 classifier (%s) on %d batches' % (backend, calib_batches))
+    # a fixed shuffle, so the same checkpoint always gets the same calibration samples
+    loader = torch.utils.data.DataLoader(calib_dataset, batch_size=batch_size, shuffle=True, num_workers=workers,
+                                         generator=torch.Generator().manual_seed(0))
+    quantized = quantize_classifier(net, loader, imageSize, transform, calib_batches, backend)
+    with torch.no_grad():
+        frozen = torch.jit.trace(quantized, torch.randn(1, 3, imageSize, imageSize))
+    torch.jit.save(frozen, path)
+    return frozen
+
+
+def evaluate(classifiers, netAttacker, loader, transform, c, min_val, max_val, nz=100, target_class=None):
+    '''Clean accuracy, attack success rate and images/s of each classifier, all attacked with the same deltas.
+
+    As in main.py, only correctly classified samples (and not of the target class) count as attacked.
+    '''
+    counts = dict((name, {'correct': 0, 'attacked': 0, 'fooled': 0, 'seconds': 0.}) for name in classifiers)
+    total = 0
+    netAttacker.eval()
+    with torch.no_grad():
+        for inputs, cls in loader:
+            inputs = transform(inputs)
+            noise = torch.randn(inputs.size(0), nz, 1, 1).mul_(0.5)
+            adv_sample = torch.clamp(netAttacker(noise) * c + inputs, min_val, max_val)
+            total += inputs.size(0)
+            for name, net in classifiers.items():
+                start = time.time()
+                pred = net(inputs).argmax(1)
+                adv_pred = net(adv_sample).argmax(1)
+                counts[name]['seconds'] += time.time() - start
+                keep = pred.eq(cls)
+                counts[name]['correct'] += keep.sum().item()
+                if target_class is not None:
+                    keep &= cls.ne(target_class)
+                    fooled = adv_pred.eq(target_class)
+                else:
+                    fooled = adv_pred.ne(pred)
+                counts[name]['attacked'] += keep.sum().item()
+                counts[name]['fooled'] += (fooled & keep).sum().item()
+    results = {}
+    for name, count in counts.items():
+        results[name] = {'clean_acc': count['correct'] / float(total),
+                         'success': count['fooled'] / float(max(count['attacked'], 1)),
+                         'images_per_sec': 2 * total / max(count['seconds'], 1e-9)}
+        print('%s: clean acc %.4f, attack success %.4f (%d of %d attacked), %.1f images/s'
+              % (name, results[name]['clean_acc'], results[name]['success'], count['fooled'], count['attacked'],
+                 results[name]['images_per_sec']))
+    return results
+
+
+if __name__ == '__main__':
+    from eval_setup import eval_parser, setup, target_class, trained_run, load_classifier, image_dataset, test_loader
+
+    parser = eval_parser('compare fp32 and int8 classifiers under a trained attack on data/test')
+    parser.add_argument('--outf', default='./logs', help='output folder of the training run to evaluate')
+    parser.add_argument('--netAttacker', default='', help='generator checkpoint (default: the last one of the run)')
+    parser.add_argument('--shrink', type=float, default=-1, help='perturbation scale c (default: the final c of the run)')
+    parser.add_argument('--calib_batches', type=int, default=32, help='number of data/train batches to calibrate on')
+    opt = parser.parse_args()
+    setup(opt)
+    run = trained_run(parser, opt.outf)
+
+    net = load_classifier(opt.netClassifier)
+    quantized = load_quantized_classifier(net, opt.netClassifier, image_dataset('train', run.imageSize, opt.cache_dir, opt.workers),
+                                          run.imageSize, run.normalize, opt.batchSize, opt.calib_batches, opt.workers)
+    c = opt.shrink if opt.shrink >= 0 else run.c
+    evaluate({'fp32': net, 'int8': quantized}, run.attacker(opt.netAttacker), test_loader(opt, run.imageSize), run.normalize,
+             c, run.min_val, run.max_val, nz=run.nz, target_class=target_class(opt))
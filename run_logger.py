@@ -0,0 +1,120 @@
+'''Buffered, structured log of a run.
+
+RunLogger keeps one file open and appends one JSON record per line, flushing
+every flush_every records instead of reopening the file for every line like
+WriteToFile. Values are stored as numbers (tensors and NumPy values are
+converted), so read_run can load a whole run back into arrays:
+
+    run = read_run('resnet-results/run.jsonl')
+    run['train']['success']     # array with one entry per logged train batch
+
+Every run appends to the same file; read_runs splits it into one such dict
+per run (each run starts with its 'options' record).
+'''
+import os
+import json
+import atexit
+
+import numpy as np
+
+
+def _to_builtin(value):
+    # tensors and numpy values -> plain numbers / lists
+    if hasattr(value, 'detach'):
+        value = value.detach().cpu().numpy()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('cannot log value of type %s' % type(value).__name__)
+
+
+class RunLogger(object):
+    '''Append-only JSONL writer: log(kind, **fields) writes {"kind": kind, ...fields}.'''
+
+    def __init__(self, fp, flush_every=100):
+        directory = os.path.dirname(fp)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.fp = fp
+        self.flush_every = flush_every
+        self.file = open(fp, 'a')
+        self.pending = 0
+        atexit.register(self.close)
+
+    def log(self, kind, **fields):
+        fields['kind'] = kind
+        self.file.write(json.dumps(fields, default=_to_builtin) + '\n')
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.file.closed:
+            self.file.flush()
+        self.pending = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def _read_records(fp):
+    with open(fp) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _to_columns(lines):
+    records = {}
+    for record in lines:
+        record = dict(record)
+        kind = record.pop('kind')
+        columns = records.setdefault(kind, {})
+        count = columns.pop('_count', 0)
+        for key, value in record.items():
+            # fields missing from earlier records of this kind are padded with None
+            columns.setdefault(key, [None] * count).append(value)
+        count += 1
+        for values in columns.values():
+            if len(values) < count:
+                values.append(None)
+        columns['_count'] = count
+    run = {}
+    for kind, columns in records.items():
+        columns.pop('_count')
+        run[kind] = {}
+        for key, values in columns.items():
+            try:
+                run[kind][key] = np.asarray(values)
+            except ValueError:
+                # ragged lists (e.g. logits of different lengths) stay as object arrays
+                run[kind][key] = np.asarray(values, dtype=object)
+    return run
+
+
+def read_run(fp):
+    '''Load a RunLogger file into {kind: {field: np.array}}, one array entry per record of that kind.'''
+    return _to_columns(_read_records(fp))
+
+
+def read_runs(fp):
+    '''Like read_run, but one dict per run in the file, split at every 'options' record.'''
+    runs = []
+    for record in _read_records(fp):
+        if record['kind'] == 'options' or not runs:
+            runs.append([])
+        runs[-1].append(record)
+    return [_to_columns(lines) for lines in runs]
+
+
+def last_complete_run(fp, kinds):
+    '''The newest run in fp that logged a record of each kind in kinds; raises ValueError if there is none.'''
+    for run in reversed(read_runs(fp)):
+        if all(kind in run for kind in kinds):
+            return run
+    raise ValueError('no run in %s has all of the %s records (was it interrupted?)' % (fp, ', '.join(kinds)))
+
+
+def last_record(run, kind):
+    '''{field: value} of the last record of kind in a run loaded by read_run / read_runs.'''
+    return dict((key, values[-1]) for key, values in run[kind].items())
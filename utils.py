@@ -1,10 +1,13 @@
 '''Some helper functions for PyTorch, including:
     - get_mean_and_std: calculate the mean and std value of dataset.
+    - cached_result: small JSON cache for per-dataset constants (norm stats, boundaries).
+    - make_loader: DataLoader factory that records loader stall time.
     - msr_init: net parameter initialization.
     - progress_bar: progress bar mimic xlua.progress.
 '''
 import os
 import sys
+import json
 import time
 import math
 import numpy as np
@@ -18,19 +21,70 @@ from torch.autograd import Variable
 
 from tqdm import tqdm
 
-def get_mean_and_std(dataset):
-    '''Compute the mean and std value of dataset.'''
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=True, num_workers=2)
-    mean = torch.zeros(3)
-    std = torch.zeros(3)
+def get_mean_and_std(dataset, batch_size=256, num_workers=4, transform=None):
+    '''Compute the per-channel mean and std value of dataset over all of its pixels.
+
+    Streams over the dataset in large batches, merging each batch's mean and sum of
+    squared deviations into the running totals (Chan et al.'s parallel Welford update),
+    so the result is the std of the pixels and not the average of per-image stds.
+    '''
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    count = 0
+    mean = torch.zeros(3, dtype=torch.float64)
+    m2 = torch.zeros(3, dtype=torch.float64)
     print('==> Computing mean and std..')
-    for inputs, targets in dataloader:
-        for i in range(3):
-            mean[i] += inputs[:,i,:,:].mean()
-            std[i] += inputs[:,i,:,:].std()
-    mean.div_(len(dataset))
-    std.div_(len(dataset))
-    return mean, std
+    for batch in dataloader:
+        inputs = batch[0]
+        if transform is not None:
+            inputs = transform(inputs)
+        x = inputs.double().transpose(0, 1).reshape(inputs.size(1), -1)
+        n = x.size(1)
+        batch_mean = x.mean(1)
+        batch_m2 = ((x - batch_mean.unsqueeze(1))**2).sum(1)
+        delta = batch_mean - mean
+        total = count + n
+        mean += delta * n / total
+        m2 += batch_m2 + delta**2 * count * n / total
+        count = total
+    std = (m2 / count).sqrt()
+    return mean.float(), std.float()
+
+
+class TimedLoader(object):
+    '''Iterates a DataLoader and adds up how long the consumer waited for batches (the stall time).'''
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.stall = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.stall = 0.
+        batches = iter(self.loader)
+        while True:
+            start = time.time()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            self.stall += time.time() - start
+            yield batch
+
+
+def make_loader(dataset, batch_size, shuffle=False, sampler=None, drop_last=False,
+                workers=2, persistent=True, prefetch=2, pin_memory=False):
+    '''DataLoader with the worker, persistence, prefetch and pinning settings in one place.
+
+    Persistent workers are kept alive between epochs instead of being re-forked.
+    '''
+    kwargs = dict(batch_size=batch_size, shuffle=shuffle, sampler=sampler, drop_last=drop_last,
+                  num_workers=workers, pin_memory=pin_memory)
+    if workers > 0:
+        kwargs.update(persistent_workers=persistent, prefetch_factor=prefetch)
+    return TimedLoader(torch.utils.data.DataLoader(dataset, **kwargs))
+
 
 def init_params(net):
     '''Init layer parameters.'''
@@ -137,6 +191,34 @@ def WriteToFile(fp, src):
         file.write('%s\n' % (src))
 
 
+def strip_data_parallel(state_dict):
+    '''Drop the "module." prefix DataParallel adds to the keys of a saved state_dict.'''
+    prefix = 'module.'
+    return {(k[len(prefix):] if k.startswith(prefix) else k): v for k, v in state_dict.items()}
+
+
+def autocast(device, enabled):
+    '''Mixed-precision context for device: bf16 on CPU, fp16 on CUDA; does nothing when not enabled.'''
+    dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=enabled)
+
+
+def freeze_parameters(net):
+    '''Stop autograd from computing (and keeping activations for) gradients of net's parameters.'''
+    for param in net.parameters():
+        param.requires_grad_(False)
+    return net
+
+
+def check_only_trainable_grads(trainable, frozen):
+    '''Raise if a parameter of frozen got a gradient, or if trainable got none at all.'''
+    frozen_grads = [name for name, param in frozen.named_parameters() if param.grad is not None]
+    if frozen_grads:
+        raise RuntimeError('frozen parameters accumulated gradients: %s' % ', '.join(frozen_grads[:5]))
+    if all(param.grad is None for param in trainable.parameters()):
+        raise RuntimeError('no gradients reached the trainable parameters')
+
+
 def weights_init(m):
     classname = m.__class__.__name__
     if classname.find('Conv') != -1:
@@ -153,11 +235,14 @@ def rescale(tensor, mean, std):
     return tensor
 
 
-def find_boundaries(train_loader):
+def find_boundaries(train_loader, transform=None):
     curr_max = 0
     curr_min = int(1e3)
-    for batch_idx, (data, cls) in tqdm(enumerate(train_loader)):
+    for batch_idx, batch in tqdm(enumerate(train_loader)):
+        data = batch[0]
         batch_size = data.size(0)
+        if transform is not None:
+            data = transform(data)
         data = Variable(data)
         prop_max = torch.max(data).item()
         if prop_max > curr_max:
@@ -167,3 +252,30 @@ def find_boundaries(train_loader):
             curr_min = prop_min
     return curr_min, curr_max 
 
+
+def analytic_boundaries(mean, std):
+    '''Smallest and largest values transforms.Normalize(mean, std) can produce from pixels in [0, 1].'''
+    curr_min = min((0 - m) / s for m, s in zip(mean, std))
+    curr_max = max((1 - m) / s for m, s in zip(mean, std))
+    return curr_min, curr_max
+
+
+def uint8_boundaries(lo, hi, mean, std):
+    '''Normalized (min, max) from per-channel uint8 pixel minima and maxima.'''
+    curr_min = min((l / 255. - m) / s for l, m, s in zip(lo, mean, std))
+    curr_max = max((h / 255. - m) / s for h, m, s in zip(hi, mean, std))
+    return curr_min, curr_max
+
+
+def cached_result(fp, key, compute):
+    '''List of floats stored in the JSON file fp under key; compute() is only called on a miss.'''
+    key = json.dumps(key, sort_keys=True)
+    cache = {}
+    if os.path.exists(fp):
+        with open(fp) as f:
+            cache = json.load(f)
+    if key not in cache:
+        cache[key] = [float(v) for v in compute()]
+        with open(fp, 'w') as f:
+            json.dump(cache, f)
+    return tuple(cache[key])